@@ -0,0 +1,143 @@
+#!/usr/bin/env python
+
+"""
+Measures how long ghdwn takes to start up, by running quick commands over
+and over in fresh interpreters, and how fast it decodes pages of search
+results:
+
+    python bench_ghdwn.py [startup|search] [runs]
+
+Each startup line is the median wall-clock time of a command, and how much
+of it is ghdwn's doing rather than the interpreter's own startup. Each
+search line is the median time to decode one page of 100 results.
+"""
+
+import codecs
+import io
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import timeit
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# Roughly what GitHub sends for each result: lots of URLs nobody reads.
+URL_FIELDS = ('archive', 'assignees', 'blobs', 'branches', 'clone',
+              'collaborators', 'comments', 'commits', 'compare', 'contents',
+              'contributors', 'deployments', 'downloads', 'events', 'forks',
+              'git', 'hooks', 'html', 'issue_events', 'issues', 'keys',
+              'labels', 'languages', 'merges', 'milestones', 'mirror',
+              'notifications', 'pulls', 'releases', 'ssh', 'stargazers',
+              'statuses', 'subscribers', 'subscription', 'svn', 'tags',
+              'teams', 'trees')
+
+
+def median_time(argv, runs, env):
+    times = []
+    with open(os.devnull, 'w') as devnull:
+        for _ in range(runs):
+            start = time.time()
+            subprocess.check_call(argv, env=env, stdout=devnull,
+                                  stderr=devnull)
+            times.append(time.time() - start)
+    return sorted(times)[len(times) // 2]
+
+
+def search_page(size=100):
+    items = []
+    for n in range(size):
+        base = 'https://api.github.com/repos/owner{0}/repo{0}'.format(n)
+        owner = dict(('{0}_url'.format(field), base) for field in
+                     ('avatar', 'events', 'followers', 'following', 'gists',
+                      'html', 'organizations', 'repos', 'starred'))
+        owner.update(login='owner{0}'.format(n), id=n, type='User',
+                     site_admin=False)
+        item = dict(('{0}_url'.format(field), base) for field in URL_FIELDS)
+        item.update(id=n, name='repo{0}'.format(n), owner=owner,
+                    full_name='owner{0}/repo{0}'.format(n), private=False,
+                    description=u'A repository \u2014 number {0}'.format(n),
+                    fork=False, created_at='2014-02-13T21:30:51Z',
+                    updated_at='2015-02-13T21:30:51Z',
+                    pushed_at='2015-02-13T21:30:51Z', homepage=None,
+                    size=1024 + n, stargazers_count=10000 - n,
+                    watchers_count=10000 - n, language='Python',
+                    forks_count=n, open_issues_count=n, score=1.0,
+                    default_branch='master')
+        items.append(item)
+    page = {'total_count': 497395, 'incomplete_results': False,
+            'items': items}
+    return json.dumps(page, indent=2).encode('utf-8')
+
+
+def bench_search(runs):
+    import ghdwn
+
+    body = search_page()
+    link = ('<https://api.github.com/search/repositories?q=language%3Apython'
+            '&sort=stars&page=2>; rel="next", '
+            '<https://api.github.com/search/repositories?q=language%3Apython'
+            '&sort=stars&page=34>; rel="last"')
+
+    def codecs_reader():
+        # How pages used to be decoded.
+        payload = json.load(codecs.getreader('utf-8')(io.BytesIO(body)))
+        return [ghdwn.RepositoryInfo.from_json(repo)
+                for repo in payload['items']]
+
+    cases = [
+        ('codecs reader', codecs_reader),
+        ('from bytes', lambda: ghdwn.decode_search_page(body)),
+        ('projection', lambda: ghdwn.decode_search_page(
+            body, ('owner.login', 'name', 'stargazers_count'))),
+        ('json only', lambda: json.loads(body.decode('utf-8'))),
+        ('link header', lambda: ghdwn.parse_link_header(link)),
+    ]
+    for name, case in cases:
+        timer = timeit.Timer(case)
+        number = max(1, int(0.05 / min(timer.repeat(3, 1))))
+        times = sorted(timer.repeat(runs, number))
+        elapsed = times[len(times) // 2] / number
+        print('{0:<14} {1:9.1f} us'.format(name, elapsed * 1e6))
+
+
+def bench_startup(runs):
+    corpus = tempfile.mkdtemp()
+    env = dict(os.environ, PYTHONPATH=HERE)
+    # Startup without cached bytecode is mostly compiling ghdwn.py.
+    env.pop('PYTHONDONTWRITEBYTECODE', None)
+    commands = [
+        ('python', [sys.executable, '-c', 'pass']),
+        ('import ghdwn', [sys.executable, '-c', 'import ghdwn']),
+        ('ghdwn status', [sys.executable, '-m', 'ghdwn', 'status', corpus]),
+        ('ghdwn stats', [sys.executable, '-m', 'ghdwn', 'stats', corpus]),
+    ]
+    try:
+        # Once to compile the module, so its bytecode is cached.
+        median_time(commands[1][1], 1, env)
+        baseline = None
+        for name, command in commands:
+            elapsed = median_time(command, runs, env)
+            if baseline is None:
+                baseline = elapsed
+            print('{0:<14} {1:7.1f} ms  (+{2:.1f} ms)'.format(
+                name, elapsed * 1000, (elapsed - baseline) * 1000))
+    finally:
+        shutil.rmtree(corpus)
+
+
+def main(argv=sys.argv):
+    benchmarks = {'startup': bench_startup, 'search': bench_search}
+    args = argv[1:]
+    chosen = [args.pop(0)] if args and args[0] in benchmarks else [
+        'startup', 'search']
+    runs = int(args[0]) if args else 20
+    for name in chosen:
+        benchmarks[name](runs)
+
+
+if __name__ == '__main__':
+    main()
@@ -7,29 +7,398 @@ library, because... uh...
 
 import codecs
 import collections
+import functools
+import heapq
 import io
 import itertools
 import json
 import logging
 import os
+import random
 import re
+import struct
 import sys
-import zipfile
+import threading
+import time
+import tokenize
+
+# Modules that are slow to import (urllib, multiprocessing, zipfile,
+# subprocess, zstandard and friends) are imported by whatever needs them, so
+# that commands that don't, like `ghdwn status`, start quickly.
 
 # These are different in Python 3...
 try:
-    from urllib.request import urlopen, Request
-    from urllib.error import HTTPError
+    import queue
 except ImportError:
-    from urllib2 import urlopen, Request, HTTPError
+    import Queue as queue
 
 __version__ = '0.2.1'
 
 GITHUB_SEARCH_URL = "https://api.github.com/search/repositories"
 GITHUB_BASE = "https://github.com"
 
+# Archives are downloaded in chunks of this many bytes.
+CHUNK_SIZE = 64 * 1024
+# How many seconds a git command that talks to the network may take before
+# it's killed.
+GIT_TIMEOUT = 10 * 60
+# Where download_repo stages archives, relative to the corpus directory.
+STAGING_DIR = '.staging'
+# How many archive members are handed to an extraction worker at once.
+BATCH_SIZE = 64
+# How many threads work on each stage of the download pipeline. None means
+# one per CPU.
+DEFAULT_WORKERS = {'fetch': 4, 'extract': 1, 'validate': None, 'write': 1}
+# How many items can wait between two stages of the pipeline.
+QUEUE_SIZE = 16
+# When written files are flushed to disk: never explicitly, as each
+# repository is committed, or once at the end of the run.
+FSYNC_POLICIES = ('none', 'repo', 'end')
+# Options of download_index() that limit the whole run, and so can't be
+# given to partitions of it: each would apply the limit on its own.
+RUN_WIDE_OPTIONS = ('sample', 'target_files', 'target_size')
+# What can be done with a file that nearly duplicates one already downloaded.
+NEAR_DEDUP_ACTIONS = ('drop', 'tag')
+# What the index is called in each of its formats.
+INDEX_FORMATS = {'json': 'index.json', 'jsonl': 'index.jsonl'}
+# What the manifest of a corpus is called, and what each worker's part of
+# it is called while building a corpus across several workers.
+MANIFEST_NAME = 'manifest.jsonl'
+MANIFEST_PART_NAME = 'manifest-{0:d}-of-{1:d}.jsonl'
+# The columnar per-file statistics of a corpus.
+FILE_STATS_NAME = 'file_stats.json'
+FILE_STATS_COLUMNS = ('bytes', 'lines', 'tokens')
+# The zstd dictionary trained for each language of a compressed corpus, how
+# big it is, and how many files it's trained on.
+DICTIONARY_NAME = 'zstd-{0}-{1}.dict'
+DICTIONARY_SIZE = 112 * 1024
+DICTIONARY_SAMPLES = 1024
+
+# Tokens that are just layout, and aren't counted.
+LAYOUT_TOKENS = frozenset([tokenize.NL, tokenize.NEWLINE, tokenize.INDENT,
+                           tokenize.DEDENT, tokenize.ENDMARKER,
+                           getattr(tokenize, 'ENCODING', None)])
+# Roughly what a token is in languages we can't tokenize properly.
+GENERIC_TOKEN = re.compile(br'\w+|[^\w\s]')
+
+# How many values are in a MinHash signature, and how many tokens are in
+# each of the shingles it's computed from.
+MINHASH_SIZE = 64
+SHINGLE_SIZE = 5
+
+# How much of a file is sniffed to see whether it's binary.
+SNIFF_SIZE = 1024
+# Magic numbers of the binary files that tend to end up in repositories.
+MAGIC_NUMBERS = (
+    (b'\x89PNG', 'png'),
+    (b'GIF8', 'gif'),
+    (b'\xff\xd8\xff', 'jpeg'),
+    (b'PK\x03\x04', 'zip'),
+    (b'\x1f\x8b', 'gzip'),
+    (b'%PDF', 'pdf'),
+    (b'\x7fELF', 'elf'),
+    (b'\xca\xfe\xba\xbe', 'class'),
+    (b'\xd0\xcf\x11\xe0', 'ole'),
+)
+# PEP 263 source file encoding declarations.
+CODING_DECLARATION = re.compile(br'^[ \t\f]*#.*?coding[:=][ \t]*([-\w.]+)')
+
+# The links in a Link: header, and the URL and relation of each one.
+LINK_SEPARATOR = re.compile(r',\s+')
+LINK = re.compile(r'<([^>]+)>;.*?rel="([^"]+)"')
+
+# Upper bounds of the buckets of every histogram in Metrics, in seconds.
+HISTOGRAM_BUCKETS = (0.005, 0.05, 0.5, 5, 50, 500)
+# How often profile_threads() samples what the threads are doing, in
+# seconds, and how many functions it reports.
+PROFILE_INTERVAL = 0.005
+PROFILE_LIMIT = 40
+
+# How recorded HTTP traffic is kept: an index of responses, and a directory
+# of their bodies, each named after the SHA-1 of its contents.
+TRAFFIC_INDEX_NAME = 'responses.jsonl'
+TRAFFIC_OBJECTS_DIR = 'objects'
+
+
+class IncompleteDownload(IOError):
+    """
+    Raised when a download ends before all of its bytes arrive.
+    """
+
+
+class NotRecorded(IOError):
+    """
+    Raised when replaying a request that was never recorded. Asking again
+    won't help, so it's never retried.
+    """
+
+
+class GitFailed(IOError):
+    """
+    Raised when a git command fails, or is killed for taking too long.
+    """
+
+
+# HTTP statuses that are worth asking for again.
+RETRY_STATUSES = frozenset((408, 429, 500, 502, 503, 504))
+
 logger = logging.getLogger()
-logging.basicConfig()
+
+
+# What web() returns.
+Web = collections.namedtuple('Web', 'urlopen Request HTTPError URLError '
+                                    'HTTPException')
+
+# What web().urlopen goes through instead of the network, if anything. See
+# use_transport().
+transport = None
+
+
+def web():
+    """
+    Imports what's needed to talk to GitHub, which takes longer than
+    anything else to import. If there's a transport in use, its urlopen
+    stands in for the real one.
+    """
+    # These are different in Python 3...
+    try:
+        from urllib.request import urlopen, Request
+        from urllib.error import HTTPError, URLError
+        from http.client import HTTPException
+    except ImportError:
+        from urllib2 import urlopen, Request, HTTPError, URLError
+        from httplib import HTTPException
+    return Web(urlopen if transport is None else transport.urlopen,
+               Request, HTTPError, URLError, HTTPException)
+
+
+def network_errors():
+    """
+    Returns everything that can go wrong while talking to GitHub. Truncated
+    bodies show up as either an IncompleteRead (an HTTPException), an
+    IncompleteDownload or a zip file that's missing its central directory.
+    """
+    import socket
+    import zipfile
+    http = web()
+    return (http.URLError, socket.error, http.HTTPException,
+            IncompleteDownload, NotRecorded, GitFailed, zipfile.BadZipfile)
+
+
+class TrafficStore(object):
+
+    """
+    Keeps HTTP responses on disk, so they can be served again later without
+    the network. Bodies are stored by the SHA-1 of their contents, so
+    identical responses are only kept once; an append-only index maps each
+    request to its status, headers and body, and the last response to a
+    request is the one that's kept.
+
+    Requests are told apart by their method, URL and Range: header. Other
+    headers, like Authorization:, are never recorded.
+
+    Unless told to `create` it, the store must already exist.
+    """
+
+    def __init__(self, directory, create=True):
+        self.directory = directory
+        self.objects_dir = os.path.join(directory, TRAFFIC_OBJECTS_DIR)
+        self.index_path = os.path.join(directory, TRAFFIC_INDEX_NAME)
+        self.lock = threading.Lock()
+        self.responses = {}
+        if not os.path.isdir(self.objects_dir):
+            if not create:
+                raise ValueError('No recorded traffic in %r' % (directory,))
+            os.makedirs(self.objects_dir)
+        if os.path.exists(self.index_path):
+            with open(self.index_path) as f:
+                for line in f:
+                    if line.endswith('\n'):
+                        record = json.loads(line)
+                        self.responses[record['request']] = record
+
+    @staticmethod
+    def key(request):
+        """
+        What a request is stored under.
+
+        >>> request = web().Request('https://github.com/x/y/archive/z.zip')
+        >>> request.add_header('Range', 'bytes=1024-')
+        >>> request.add_header('Authorization', 'token hunter2')
+        >>> TrafficStore.key(request)
+        'GET https://github.com/x/y/archive/z.zip bytes=1024-'
+        """
+        return ' '.join(filter(None, [request.get_method(),
+                                      request.get_full_url(),
+                                      request.get_header('Range')]))
+
+    def object_path(self, digest):
+        return os.path.join(self.objects_dir, digest[:2], digest[2:])
+
+    def save(self, request, status, headers, body, reason=None):
+        """
+        Stores the response to the request, reading its body from the given
+        file-like object, and returns it as a RecordedResponse.
+        """
+        import hashlib
+        import tempfile
+        digest = hashlib.sha1()
+        fd, temporary = tempfile.mkstemp(dir=self.objects_dir)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                for chunk in iter(functools.partial(body.read, CHUNK_SIZE),
+                                  b''):
+                    digest.update(chunk)
+                    f.write(chunk)
+            path = self.object_path(digest.hexdigest())
+            if not os.path.isdir(os.path.dirname(path)):
+                try:
+                    os.makedirs(os.path.dirname(path))
+                except OSError:
+                    # Another thread got there first.
+                    pass
+            os.rename(temporary, path)
+        except BaseException:
+            os.remove(temporary)
+            raise
+
+        record = {'request': self.key(request), 'status': status,
+                  'reason': reason, 'headers': list(headers.items()),
+                  'body': digest.hexdigest()}
+        with self.lock:
+            with open(self.index_path, 'a') as f:
+                f.write(json.dumps(record, sort_keys=True) + '\n')
+            self.responses[record['request']] = record
+        return self.load(request)
+
+    def load(self, request):
+        """
+        Returns the stored response to the request as a RecordedResponse,
+        or None if it was never recorded.
+        """
+        import email.message
+        record = self.responses.get(self.key(request))
+        if record is None:
+            return None
+        headers = email.message.Message()
+        for name, value in record['headers']:
+            headers[str(name)] = str(value)
+        return RecordedResponse(request.get_full_url(), record['status'],
+                                record['reason'], headers,
+                                self.object_path(record['body']))
+
+
+class RecordedResponse(object):
+
+    """
+    A response served from a TrafficStore, which reads like one from
+    urlopen().
+    """
+
+    def __init__(self, url, status, reason, headers, path):
+        self.url = url
+        self.code = status
+        self.msg = reason
+        self.headers = headers
+        self.fp = open(path, 'rb')
+        self.read = self.fp.read
+
+    def info(self):
+        return self.headers
+
+    def getcode(self):
+        return self.code
+
+    def geturl(self):
+        return self.url
+
+    def close(self):
+        self.fp.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def raise_for_status(self):
+        """
+        Raises the HTTPError that urlopen() would have for this response.
+        """
+        if self.code >= 400:
+            raise web().HTTPError(self.url, self.code, self.msg,
+                                  self.headers, self.fp)
+        return self
+
+
+class RecordingTransport(object):
+
+    """
+    Talks to the network with `urlopen`, and records every response in the
+    store as it goes, HTTP errors included.
+    """
+
+    mode = 'record'
+
+    def __init__(self, store, urlopen):
+        self.store = store
+        self.real_urlopen = urlopen
+
+    def urlopen(self, request, timeout=None):
+        try:
+            response = self.real_urlopen(request, timeout=timeout)
+        except web().HTTPError as error:
+            body = error if getattr(error, 'fp', None) else io.BytesIO()
+            self.store.save(request, error.code, error.info() or {}, body,
+                            reason=error.msg).close()
+            raise
+        try:
+            return self.store.save(request, response.getcode(),
+                                   response.info(), response)
+        finally:
+            response.close()
+
+
+class ReplayingTransport(object):
+
+    """
+    Serves responses from the store, and never touches the network. Asking
+    for anything that wasn't recorded is a NotRecorded error.
+    """
+
+    mode = 'replay'
+
+    def __init__(self, store, urlopen=None):
+        self.store = store
+
+    def urlopen(self, request, timeout=None):
+        response = self.store.load(request)
+        if response is None:
+            raise NotRecorded('Not recorded: {0}'.format(
+                self.store.key(request)))
+        return response.raise_for_status()
+
+
+TRANSPORTS = dict((cls.mode, cls)
+                  for cls in (RecordingTransport, ReplayingTransport))
+
+
+def use_transport(mode, directory=None):
+    """
+    Sends every HTTP request through a transport: 'record' saves the
+    responses from GitHub in the directory as they arrive, and 'replay'
+    serves them back from it, without the network, so that a run can be
+    repeated exactly. A mode of None goes back to just using the network.
+    Replaying needs a directory that traffic was recorded to.
+
+    Only HTTP goes through the transport, so the git backend can't be
+    recorded.
+    """
+    global transport
+    transport = None
+    if mode is not None:
+        store = TrafficStore(directory, create=mode != 'replay')
+        transport = TRANSPORTS[mode](store, web().urlopen)
 
 
 class GitHubSearchRequester(object):
@@ -39,29 +408,30 @@ class GitHubSearchRequester(object):
     of the way it is. Wow.
     """
 
-    def __init__(self, language):
+    def __init__(self, language, retry=None):
         self.requests_left = 1
         self.next_url = create_search_url(language, quantity=100)
         self.buffer = None
+        self.retry = retry or RetryPolicy()
 
     def __iter__(self):
         return self
 
     def request_next_page(self):
         # Do that nasty request
-        response = urlopen(create_github_request(self.next_url))
+        response = web().urlopen(create_github_request(self.next_url),
+                                 timeout=self.retry.timeout)
 
         assert 'charset=utf-8' in response.info().get('Content-Type')
 
-        reader = codecs.getreader("utf-8")
-        payload = json.load(reader(response))
-
-        link_header = response.info().get('Link', '')
-
         # Set the new buffer's contents.
-        self.buffer = [RepositoryInfo.from_json(repo)
-                       for repo in payload['items']]
+        self.buffer = decode_search_page(response.read())
 
+        remaining = response.info().get('X-RateLimit-Remaining')
+        if remaining is not None:
+            live_metrics.set('ghdwn_rate_limit_remaining', int(remaining))
+
+        link_header = response.info().get('Link', '')
         self.next_url = parse_link_header(link_header).get('next', None)
 
     def next(self):
@@ -73,9 +443,9 @@ class GitHubSearchRequester(object):
             raise StopIteration()
 
         try:
-            self.request_next_page()
+            self.retry.call(self.request_next_page)
         # Some HTTP error occurred. Return no results.
-        except HTTPError:
+        except network_errors():
             self.buffer = []
 
         if self.buffer:
@@ -87,39 +457,774 @@ class GitHubSearchRequester(object):
     __next__ = next
 
 
+class RetryPolicy(object):
+
+    """
+    Decides how many times, and how patiently, to retry a flaky request.
+
+    Delays grow exponentially from `backoff` seconds up to `max_backoff`
+    seconds, and are jittered so that a bunch of downloads don't all hammer
+    GitHub again at the exact same moment. The `budget` is the total number
+    of retries shared by everything using this policy, so a totally broken
+    network gives up instead of backing off forever.
+    """
+
+    def __init__(self, attempts=4, backoff=1.0, max_backoff=60.0,
+                 timeout=60.0, budget=256, sleep=time.sleep,
+                 random=random.random):
+        self.attempts = attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.timeout = timeout
+        self.budget = budget
+        self.sleep = sleep
+        self.random = random
+        self._lock = threading.Lock()
+
+    def delay(self, attempt):
+        """
+        Returns how long to wait after the given (zero-indexed) attempt.
+
+        >>> policy = RetryPolicy(backoff=2.0, max_backoff=5.0,
+        ...                      random=lambda: 1.0)
+        >>> [policy.delay(n) for n in range(4)]
+        [2.0, 4.0, 5.0, 5.0]
+        """
+        ceiling = min(self.max_backoff, self.backoff * 2 ** attempt)
+        return ceiling * self.random()
+
+    def should_retry(self, attempt, error):
+        """
+        Returns True (and spends some budget) if the failed attempt deserves
+        another go.
+
+        >>> import socket
+        >>> policy = RetryPolicy(attempts=3, budget=1)
+        >>> policy.should_retry(0, socket.timeout('timed out'))
+        True
+        >>> policy.should_retry(0, socket.timeout('timed out'))
+        False
+        """
+        if attempt + 1 >= self.attempts or self.budget <= 0:
+            return False
+        if not is_transient(error):
+            return False
+        with self._lock:
+            if self.budget <= 0:
+                return False
+            self.budget -= 1
+        return True
+
+    def call(self, function, *args, **kwargs):
+        """
+        Calls the function until it succeeds, or until it's not worth trying
+        anymore, in which case the last error is raised.
+        """
+        attempt = 0
+        while True:
+            try:
+                return function(*args, **kwargs)
+            except network_errors() as error:
+                if not self.should_retry(attempt, error):
+                    raise
+                delay = self.delay(attempt)
+                logger.warning('%s; retrying in %.1f seconds...', error, delay)
+                self.sleep(delay)
+                attempt += 1
+
+
+class IndexWriter(object):
+
+    """
+    Writes the index of a corpus.
+
+    In the 'jsonl' format, each repository is appended to the file as its
+    own line of JSON as soon as it's written, so the index survives a crash
+    and can be read while it's still being written. The 'json' format is a
+    single JSON array, written all at once when the writer is closed.
+    """
+
+    def __init__(self, path, format='json'):
+        if format not in INDEX_FORMATS:
+            raise ValueError('Unknown index format: %r' % (format,))
+        self.path = path
+        self.format = format
+        self.repos = []
+        self.file = open(path, 'w') if format == 'jsonl' else None
+
+    def write(self, repo):
+        if self.file is None:
+            self.repos.append(repo)
+            return
+        self.file.write(json.dumps(repo.as_dict(), sort_keys=True) + '\n')
+        self.file.flush()
+
+    def close(self):
+        if self.file is None:
+            with open(self.path, 'w') as f:
+                json.dump([repo.as_dict() for repo in self.repos], f)
+        else:
+            self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class Manifest(object):
+
+    """
+    Records the files written for each repository in a corpus, as a line of
+    JSON per repository, appended as soon as the repository is done.
+    Records for repositories downloaded again are simply appended again;
+    the last one wins (see load_manifest).
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.file = open(path, 'a')
+
+    def write(self, repo, files, mirror_of=None, rejected=None):
+        """
+        Records the files written for the repository, given as a dict of
+        each file's path (relative to the repository's directory) to any
+        metadata about it. If the repository was skipped for being a mirror
+        of another, says which one. `rejected` is a dict of the same kind,
+        for files that were left out.
+        """
+        record = {'repository': repo.as_dict(), 'files': files}
+        if mirror_of is not None:
+            record['mirror_of'] = mirror_of
+        if rejected:
+            record['rejected'] = rejected
+        with self.lock:
+            self.file.write(json.dumps(record, sort_keys=True) + '\n')
+            self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+class NearDuplicateIndex(object):
+
+    """
+    Finds files that are nearly the same as a file seen before, using
+    locality-sensitive hashing of their MinHash signatures (see
+    minhash_signature).
+
+    Signatures are split into `bands`; files that share any band are
+    candidates, and a candidate is a near duplicate if the signatures agree
+    on at least `threshold` of their values.
+
+    >>> index = NearDuplicateIndex(threshold=0.75, bands=2)
+    >>> index.add('a.py', [1, 2, 3, 4]) is None
+    True
+    >>> index.add('b.py', [1, 2, 3, 5])
+    'a.py'
+    >>> index.add('c.py', [1, 2, 6, 7]) is None
+    True
+    >>> index.remove('a.py')
+    >>> index.add('b.py', [1, 2, 3, 5]) is None
+    True
+    """
+
+    def __init__(self, threshold=0.8, bands=16):
+        self.threshold = threshold
+        self.bands = bands
+        self.buckets = {}
+        self.signatures = {}
+        self.lock = threading.Lock()
+
+    def __contains__(self, key):
+        with self.lock:
+            return key in self.signatures
+
+    def band_keys(self, signature):
+        rows = max(1, len(signature) // self.bands)
+        return [(start, tuple(signature[start:start + rows]))
+                for start in range(0, len(signature), rows)]
+
+    def add(self, key, signature):
+        """
+        Returns the key of a file the signature's file nearly duplicates.
+        If there is none, the signature is indexed and None is returned.
+        A file never duplicates itself.
+        """
+        band_keys = self.band_keys(signature)
+        with self.lock:
+            for band_key in band_keys:
+                for other in self.buckets.get(band_key, ()):
+                    if other == key:
+                        continue
+                    agreement = similarity(signature, self.signatures[other])
+                    if agreement >= self.threshold:
+                        return other
+
+            self._remove(key)
+            self.signatures[key] = tuple(signature)
+            for band_key in band_keys:
+                self.buckets.setdefault(band_key, []).append(key)
+        return None
+
+    def remove(self, key):
+        """
+        Forgets the file with the given key, if it was indexed, so that
+        nothing is found to duplicate it anymore.
+        """
+        with self.lock:
+            self._remove(key)
+
+    def _remove(self, key):
+        signature = self.signatures.pop(key, None)
+        if signature is None:
+            return
+        for band_key in self.band_keys(signature):
+            bucket = self.buckets[band_key]
+            bucket.remove(key)
+            if not bucket:
+                del self.buckets[band_key]
+
+
+class Sampler(object):
+
+    """
+    Keeps a fixed-size random sample of a corpus's files: at most `total`
+    files overall, and at most `per_repo` from any one repository.
+
+    Every file gets a pseudo-random key from its repository, its path and
+    the `seed`, and the sample is whichever files have the smallest keys
+    (a bottom-k sample). So whether a file could make the cut is known from
+    its name alone, before it's even inflated (see wanted()). Files that
+    made it at first can still be pushed out by files found later with
+    smaller keys; see take_evicted().
+
+    >>> sampler = Sampler(total=2, seed=1)
+    >>> paths = ['x.py', 'y.py', 'z.py']
+    >>> kept = [path for path in paths if sampler.add('a/b', path)]
+    >>> kept = set(kept) - set(path for _, path in sampler.take_evicted())
+    >>> smallest = sorted(paths, key=lambda path: sampler.key('a/b', path))
+    >>> sorted(kept) == sorted(smallest[:2])
+    True
+    >>> sampler.discard('a/b'); len(sampler.kept)
+    0
+    """
+
+    def __init__(self, total=None, per_repo=None, seed=0):
+        self.total = total
+        self.per_repo = per_repo
+        self.seed = seed
+        # Max-heaps (by negated key) of the files kept, overall and for
+        # each repository. Files evicted from one are lazily dropped from
+        # the other.
+        self.heap = []
+        self.repo_heaps = collections.defaultdict(list)
+        self.kept = set()
+        self.repo_counts = collections.defaultdict(int)
+        self.evicted = []
+        self.lock = threading.Lock()
+
+    def key(self, repo, path):
+        """
+        Returns the file's key: the same for every run with the same seed.
+        """
+        import hashlib
+        name = '{0}:{1}/{2}'.format(self.seed, repo, path)
+        return int(hashlib.md5(name.encode('utf-8')).hexdigest()[:15], 16)
+
+    def wanted(self, repo, path):
+        """
+        Returns whether the file would make the cut if it were kept now.
+        """
+        key = self.key(repo, path)
+        with self.lock:
+            return self._wanted(str(repo), key)
+
+    def add(self, repo, path):
+        """
+        Keeps the file if it makes the cut, evicting whichever files no
+        longer do. Returns whether it was kept.
+        """
+        repo, key = str(repo), self.key(repo, path)
+        with self.lock:
+            if not self._wanted(repo, key):
+                return False
+            entry = (-key, repo, path)
+            self.kept.add(entry)
+            self.repo_counts[repo] += 1
+            heapq.heappush(self.heap, entry)
+            heapq.heappush(self.repo_heaps[repo], entry)
+            if self.per_repo and self.repo_counts[repo] > self.per_repo:
+                self._evict(self.repo_heaps[repo])
+            if self.total and len(self.kept) > self.total:
+                self._evict(self.heap)
+            if entry not in self.kept:
+                self.evicted.remove(entry[1:])
+                return False
+            return True
+
+    def _wanted(self, repo, key):
+        full = self.total and len(self.kept) >= self.total
+        if full and key >= -self._largest(self.heap)[0]:
+            return False
+        full = self.per_repo and self.repo_counts[repo] >= self.per_repo
+        if full and key >= -self._largest(self.repo_heaps[repo])[0]:
+            return False
+        return True
+
+    def _largest(self, heap):
+        while heap[0] not in self.kept:
+            heapq.heappop(heap)
+        return heap[0]
+
+    def _evict(self, heap):
+        entry = self._largest(heap)
+        heapq.heappop(heap)
+        self.kept.discard(entry)
+        self.repo_counts[entry[1]] -= 1
+        self.evicted.append(entry[1:])
+
+    def discard(self, repo):
+        """
+        Takes every file of the repository back out of the sample, as if it
+        had never been added.
+        """
+        repo = str(repo)
+        with self.lock:
+            self.kept = set(entry for entry in self.kept
+                            if entry[1] != repo)
+            self.repo_counts.pop(repo, None)
+            self.repo_heaps.pop(repo, None)
+            self.evicted = [entry for entry in self.evicted
+                            if entry[0] != repo]
+
+    def take_evicted(self):
+        """
+        Returns the (repository, path) of every file evicted since last
+        time.
+        """
+        with self.lock:
+            evicted, self.evicted = self.evicted, []
+        return evicted
+
+
+class CorpusStats(object):
+
+    """
+    Tallies what happened during a corpus build. Safe to update from any
+    thread. Everything tallied is also counted in the metrics.
+
+    >>> stats = CorpusStats()
+    >>> stats.add('files', 3)
+    >>> stats.reject('syntax')
+    >>> stats.counts['files'], stats.rejected['syntax']
+    (3, 1)
+    """
+
+    def __init__(self):
+        self.counts = collections.defaultdict(int)
+        self.rejected = collections.defaultdict(int)
+        self.lock = threading.Lock()
+
+    def add(self, name, amount=1):
+        with self.lock:
+            self.counts[name] += amount
+        # Counters can only go up.
+        if amount > 0:
+            live_metrics.add('ghdwn_{0}_total'.format(name), amount)
+
+    def reject(self, reason, amount=1):
+        with self.lock:
+            self.rejected[reason] += amount
+        if amount > 0:
+            live_metrics.add('ghdwn_rejected_files_total', amount,
+                             reason=reason)
+
+    def __str__(self):
+        tallies = sorted(self.counts.items()) + sorted(
+            ('rejected ' + reason, amount)
+            for reason, amount in self.rejected.items())
+        return ', '.join('{0}: {1:d}'.format(*pair) for pair in tallies)
+
+
+class Metrics(object):
+
+    """
+    Live measurements of whatever ghdwn is up to, which serve_metrics()
+    exposes in Prometheus's text format. Counters only ever go up, gauges
+    are set (or watched, by calling a function whenever they're exposed),
+    and histograms count observations in HISTOGRAM_BUCKETS. Safe to update
+    from any thread.
+
+    >>> metrics = Metrics()
+    >>> metrics.add('ghdwn_files_total', 3)
+    >>> metrics.watch('ghdwn_queue_length', lambda: 2, stage='write')
+    >>> metrics.observe('ghdwn_stage_seconds', 0.2, stage='fetch')
+    >>> print(metrics.render())
+    # TYPE ghdwn_files_total counter
+    ghdwn_files_total 3
+    # TYPE ghdwn_queue_length gauge
+    ghdwn_queue_length{stage="write"} 2
+    # TYPE ghdwn_stage_seconds histogram
+    ghdwn_stage_seconds_bucket{stage="fetch",le="0.005"} 0
+    ghdwn_stage_seconds_bucket{stage="fetch",le="0.05"} 0
+    ghdwn_stage_seconds_bucket{stage="fetch",le="0.5"} 1
+    ghdwn_stage_seconds_bucket{stage="fetch",le="5"} 1
+    ghdwn_stage_seconds_bucket{stage="fetch",le="50"} 1
+    ghdwn_stage_seconds_bucket{stage="fetch",le="500"} 1
+    ghdwn_stage_seconds_bucket{stage="fetch",le="+Inf"} 1
+    ghdwn_stage_seconds_sum{stage="fetch"} 0.2
+    ghdwn_stage_seconds_count{stage="fetch"} 1
+    <BLANKLINE>
+    """
+
+    def __init__(self):
+        self.kinds = {}
+        self.values = {}
+        self.watched = {}
+        self.server = None
+        self.lock = threading.Lock()
+
+    def add(self, name, amount=1, kind='counter', **labels):
+        """
+        Adds to a counter, or to a gauge given `kind='gauge'`.
+        """
+        key = self.key(name, kind, labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def set(self, name, value, **labels):
+        key = self.key(name, 'gauge', labels)
+        with self.lock:
+            self.values[key] = value
+
+    def watch(self, name, function, **labels):
+        key = self.key(name, 'gauge', labels)
+        with self.lock:
+            self.watched[key] = function
+
+    def observe(self, name, value, **labels):
+        key = self.key(name, 'histogram', labels)
+        with self.lock:
+            # The count in each bucket, then the sum and the count of
+            # every observation.
+            histogram = self.values.setdefault(
+                key, [0] * (len(HISTOGRAM_BUCKETS) + 2))
+            for n, bound in enumerate(HISTOGRAM_BUCKETS):
+                if value <= bound:
+                    histogram[n] += 1
+                    break
+            histogram[-2] += value
+            histogram[-1] += 1
+
+    def key(self, name, kind, labels):
+        self.kinds.setdefault(name, kind)
+        return name, tuple(sorted(labels.items()))
+
+    def render(self):
+        with self.lock:
+            values = dict((key, list(value) if isinstance(value, list)
+                           else value) for key, value in self.values.items())
+            values.update((key, function())
+                          for key, function in self.watched.items())
+            kinds = dict(self.kinds)
+
+        lines = []
+        for name in sorted(kinds):
+            lines.append('# TYPE {0} {1}'.format(name, kinds[name]))
+            for (_, labels), value in sorted(
+                    (key, value) for key, value in values.items()
+                    if key[0] == name):
+                if kinds[name] != 'histogram':
+                    lines.append(sample_line(name, labels, value))
+                    continue
+                cumulative = 0
+                for bound, count in zip(HISTOGRAM_BUCKETS, value):
+                    cumulative += count
+                    lines.append(sample_line(name + '_bucket', labels +
+                                             (('le', str(bound)),),
+                                             cumulative))
+                lines.append(sample_line(name + '_bucket', labels +
+                                         (('le', '+Inf'),), value[-1]))
+                lines.append(sample_line(name + '_sum', labels, value[-2]))
+                lines.append(sample_line(name + '_count', labels,
+                                         value[-1]))
+        return '\n'.join(lines) + '\n'
+
+
+def sample_line(name, labels, value):
+    """
+    Formats one sample in Prometheus's text format.
+
+    >>> sample_line('ghdwn_files_total', (('reason', 'say "hi"'),), 2.0)
+    'ghdwn_files_total{reason="say \\\\"hi\\\\""} 2'
+    """
+    if labels:
+        name += '{' + ','.join(
+            '{0}="{1}"'.format(label, str(text).replace('\\', '\\\\')
+                               .replace('"', '\\"').replace('\n', '\\n'))
+            for label, text in labels) + '}'
+    if isinstance(value, float) and value.is_integer():
+        value = int(value)
+    return '{0} {1}'.format(name, value)
+
+
+# Every live metric of this process. Not to be confused with the metrics
+# of files (see file_metrics).
+live_metrics = Metrics()
+
+
+def serve_metrics(address):
+    """
+    Serves the metrics over HTTP at the given (host, port), from a thread
+    of its own, and returns the server. Besides /metrics, there's:
+
+     * /debug/stacks: what every thread is doing right now;
+     * /debug/profile?seconds=N: which functions the threads spent the
+       next N seconds (by default, 10) in; see profile_threads().
+    """
+    try:
+        from http.server import BaseHTTPRequestHandler, HTTPServer
+        from socketserver import ThreadingMixIn
+    except ImportError:
+        from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+        from SocketServer import ThreadingMixIn
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            path, _, query = self.path.partition('?')
+            options = dict(pair.split('=', 1) for pair in query.split('&')
+                           if '=' in pair)
+            if path == '/metrics':
+                body = live_metrics.render()
+            elif path == '/debug/stacks':
+                body = dump_stacks()
+            elif path == '/debug/profile':
+                body = profile_threads(float(options.get('seconds', 10)))
+            else:
+                self.send_error(404)
+                return
+            body = body.encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type',
+                             'text/plain; version=0.0.4; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            logger.debug('Metrics: ' + format, *args)
+
+    class MetricsServer(ThreadingMixIn, HTTPServer):
+        daemon_threads = True
+
+    server = MetricsServer(address, MetricsHandler)
+    thread = threading.Thread(target=server.serve_forever, name='metrics')
+    thread.daemon = True
+    thread.start()
+    live_metrics.server = server
+    logger.info('Serving metrics on http://%s:%d/metrics',
+                *server.server_address[:2])
+    return server
+
+
+def parse_address(text):
+    """
+    Parses a [HOST:]PORT to listen on. Without a host, only this machine
+    can connect.
+
+    >>> parse_address('9100'), parse_address('0.0.0.0:9100')
+    (('127.0.0.1', 9100), ('0.0.0.0', 9100))
+    """
+    host, _, port = text.rpartition(':')
+    return host or '127.0.0.1', int(port)
+
+
+def dump_stacks():
+    """
+    Returns the stack of every thread, like a traceback.
+    """
+    import traceback
+    names = dict((thread.ident, thread.name)
+                 for thread in threading.enumerate())
+    lines = []
+    for ident, frame in sorted(sys._current_frames().items()):
+        lines.append('Thread {0} ({1:d}):\n'.format(
+            names.get(ident, 'unknown'), ident))
+        lines.extend(traceback.format_stack(frame))
+        lines.append('\n')
+    return ''.join(lines)
+
+
+def profile_threads(seconds, interval=PROFILE_INTERVAL, limit=PROFILE_LIMIT):
+    """
+    Profiles every other thread for the given number of seconds, by
+    sampling their stacks, and reports the functions they were seen in
+    most: how often each was at the top of a stack (self) and anywhere in
+    it (total). Unlike cProfile, this sees into threads that were already
+    running, and hardly slows them down.
+    """
+    me = threading.current_thread().ident
+    top, anywhere = collections.Counter(), collections.Counter()
+    samples = 0
+    deadline = time.time() + seconds
+    while True:
+        for ident, frame in sys._current_frames().items():
+            if ident == me:
+                continue
+            samples += 1
+            seen = set()
+            top[function_name(frame)] += 1
+            while frame is not None:
+                seen.add(function_name(frame))
+                frame = frame.f_back
+            anywhere.update(seen)
+        if time.time() >= deadline:
+            break
+        time.sleep(interval)
+
+    lines = ['{0:d} samples over {1:g} seconds\n'.format(samples, seconds),
+             '{0:>7} {1:>7}  function\n'.format('self', 'total')]
+    for name, count in anywhere.most_common(limit):
+        lines.append('{0:6.1f}% {1:6.1f}%  {2}\n'.format(
+            100.0 * top[name] / samples, 100.0 * count / samples, name))
+    return ''.join(lines)
+
+
+def function_name(frame):
+    code = frame.f_code
+    return '{0} ({1}:{2:d})'.format(code.co_name, code.co_filename,
+                                    code.co_firstlineno)
+
+
+@functools.total_ordering
 class RepositoryInfo(object):
-    STANDARD_ATTRS = ('owner', 'name', 'default_branch')
 
-    def __init__(self, owner, repo, default_branch='master'):
-        self.owner = owner
-        self.name = repo
-        self.default_branch = default_branch
+    """
+    A repository on GitHub. These are immutable and hashable, so they can be
+    deduplicated with a set, and sort by owner, then name.
+
+    Two RepositoryInfos are the same repository if their owner, name and
+    default branch match. They're also equal to an (owner, name) tuple, and
+    hash like one, so `repo.key` can be used wherever a tuple is expected.
+
+    >>> repos = {RepositoryInfo('django', 'django'),
+    ...          RepositoryInfo('django', 'django')}
+    >>> len(repos), ('django', 'django') in repos
+    (1, True)
+    >>> sorted([RepositoryInfo('z', 'a'), RepositoryInfo('a', 'z')])
+    [RepositoryInfo('a', 'z', 'master'), RepositoryInfo('z', 'a', 'master')]
+    """
+
+    STANDARD_ATTRS = ('owner', 'name', 'default_branch')
+    # Optional metadata from the search results. None if unknown. `parent`
+    # is the "owner/name" of the repository a fork was forked from.
+    EXTRA_ATTRS = ('stars', 'size', 'pushed_at', 'fork', 'parent')
+
+    __slots__ = ('key',) + STANDARD_ATTRS + EXTRA_ATTRS
+
+    def __init__(self, owner, repo, default_branch='master', stars=None,
+                 size=None, pushed_at=None, fork=None, parent=None):
+        # Sidestep our own __setattr__.
+        initialize = super(RepositoryInfo, self).__setattr__
+        initialize('key', (owner, repo))
+        initialize('owner', owner)
+        initialize('name', repo)
+        initialize('default_branch', default_branch)
+        initialize('stars', stars)
+        initialize('size', size)
+        initialize('pushed_at', pushed_at)
+        initialize('fork', fork)
+        initialize('parent', parent)
+
+    def __setattr__(self, name, value):
+        raise AttributeError('RepositoryInfo is immutable')
+
+    def __delattr__(self, name):
+        raise AttributeError('RepositoryInfo is immutable')
+
+    def __reduce__(self):
+        return (RepositoryInfo, tuple(getattr(self, attr) for attr in
+                                      self.STANDARD_ATTRS + self.EXTRA_ATTRS))
 
     @property
     def archive_url(self):
-        return "{base}/{owner}/{name}/archive/{default_branch}.zip".format(
-            base=GITHUB_BASE, **vars(self))
+        return "{0}/{1}/{2}/archive/{3}.zip".format(
+            GITHUB_BASE, self.owner, self.name, self.default_branch)
 
     def __repr__(self):
-        args = ', '.join(repr(getattr(self, name))
-                         for name in self.STANDARD_ATTRS)
-        return 'RepositoryInfo({0:s})'.format(args)
+        return 'RepositoryInfo({0!r}, {1!r}, {2!r})'.format(
+            self.owner, self.name, self.default_branch)
 
     def __str__(self):
-        return "{owner}/{name}".format(**vars(self))
+        return "{0}/{1}".format(self.owner, self.name)
+
+    def __hash__(self):
+        return hash(self.key)
 
     def __eq__(self, other):
+        if isinstance(other, RepositoryInfo):
+            return (self.key == other.key and
+                    self.default_branch == other.default_branch)
         if isinstance(other, tuple):
-            return self.__tuple_eq__(other)
-        return all(getattr(self, attr) == getattr(other, attr)
-                   for attr in self.STANDARD_ATTRS)
+            return self.key == other[:2]
+        return NotImplemented
+
+    def __ne__(self, other):
+        equal = self.__eq__(other)
+        return equal if equal is NotImplemented else not equal
 
-    def __tuple_eq__(self, other):
-        return self.owner == other[0] and self.name == other[1]
+    def __lt__(self, other):
+        if not isinstance(other, RepositoryInfo):
+            return NotImplemented
+        return ((self.key, self.default_branch) <
+                (other.key, other.default_branch))
+
+    @property
+    def size_in_bytes(self):
+        """
+        Roughly how big the repository is. GitHub reports sizes in KiB.
+
+        >>> RepositoryInfo('eddieantonio', 'dev', size=29).size_in_bytes
+        29696
+        >>> RepositoryInfo('eddieantonio', 'dev').size_in_bytes is None
+        True
+        """
+        return self.size * 1024 if self.size is not None else None
 
     def as_dict(self):
-        return dict((attr, getattr(self, attr))
-                    for attr in self.STANDARD_ATTRS)
+        attrs = dict((attr, getattr(self, attr))
+                     for attr in self.STANDARD_ATTRS)
+        attrs.update((attr, getattr(self, attr))
+                     for attr in self.EXTRA_ATTRS
+                     if getattr(self, attr) is not None)
+        return attrs
+
+    @classmethod
+    def from_dict(cls, attrs):
+        """
+        Creates a RepositoryInfo object from the output of as_dict().
+        Owners and names become directories of the corpus, so anything that
+        isn't a single directory name is refused.
+
+        >>> repo = RepositoryInfo('eddieantonio', 'dev', 'dev', stars=28)
+        >>> RepositoryInfo.from_dict(repo.as_dict()).stars
+        28
+        >>> RepositoryInfo.from_dict({'owner': '..', 'name': 'victim'})
+        Traceback (most recent call last):
+          ...
+        ValueError: Bad repository owner: '..'
+        """
+        for attr in ('owner', 'name'):
+            part = attrs[attr]
+            if part in ('', '.', '..') or '/' in part or '\\' in part:
+                raise ValueError('Bad repository {0}: {1!r}'.format(
+                    attr, part))
+        return cls(attrs['owner'], attrs['name'],
+                   attrs.get('default_branch', 'master'),
+                   **dict((attr, attrs.get(attr)) for attr in cls.EXTRA_ATTRS))
 
     @classmethod
     def from_json(cls, json):
@@ -133,26 +1238,74 @@ class RepositoryInfo(object):
         >>> json['default_branch'] = 'dev'
         >>> RepositoryInfo.from_json(json)
         RepositoryInfo('eddieantonio', 'dev', 'dev')
+        >>> json['stargazers_count'] = 28
+        >>> RepositoryInfo.from_json(json).stars
+        28
+        >>> json.update(fork=True, parent={'full_name': 'django/django'})
+        >>> RepositoryInfo.from_json(json).parent
+        'django/django'
 
         """
         owner = json['owner']['login']
         name = json['name']
         default_branch = json.get('default_branch', 'master')
+        parent = json.get('parent') or {}
 
-        return cls(owner, name, default_branch)
+        return cls(owner, name, default_branch,
+                   stars=json.get('stargazers_count'),
+                   size=json.get('size'),
+                   pushed_at=json.get('pushed_at'),
+                   fork=json.get('fork'),
+                   parent=parent.get('full_name'))
 
 
-def get_github_list(language, quantity=1024):
+def get_github_list(language, quantity=1024, retry=None):
     """
     Returns a great big list of suitable owner/repository tuples for the given
     language.
     """
     # GitHubSearchRequester does the bulk of the work. Using islice to emit at most
     # `quantity` results.
-    urls = itertools.islice(GitHubSearchRequester(language), quantity)
+    urls = itertools.islice(GitHubSearchRequester(language, retry), quantity)
     return list(urls)
 
 
+def load_index(path):
+    """
+    Returns the list of repositories in an index file, in either format.
+    """
+    with open(path) as f:
+        first_line = f.readline()
+    if first_line.lstrip().startswith('['):
+        with open(path) as f:
+            return [RepositoryInfo.from_dict(attrs) for attrs in json.load(f)]
+    return list(read_index(path))
+
+
+def read_index(path, follow=False, interval=1.0):
+    """
+    Yields repositories from a JSON Lines index as they're written. A line
+    that's still being written is left for later. With `follow`, keeps
+    waiting for new lines (like `tail -f`) instead of stopping at the end of
+    the file.
+    """
+    with open(path) as f:
+        partial = ''
+        while True:
+            line = f.readline()
+            if line.endswith('\n'):
+                line, partial = partial + line, ''
+                if line.strip():
+                    yield RepositoryInfo.from_dict(json.loads(line))
+                continue
+
+            # At the end of the file, possibly with part of a line.
+            partial += line
+            if not follow:
+                return
+            time.sleep(interval)
+
+
 def parse_link_header(header):
     """
     Parses the content of a Link: header.
@@ -166,11 +1319,11 @@ def parse_link_header(header):
     >>> parse_link_header('')
     {}
     """
-    raw_links = re.split(r',\s+', header) if header.strip() else []
+    raw_links = LINK_SEPARATOR.split(header) if header.strip() else []
 
     links = {}
     for text in raw_links:
-        match = re.search(r'^<([^>]+)>;.*?rel="([^"]+)"', text)
+        match = LINK.match(text)
         if not match:
             raise ValueError('Could not find links in header: %r' % (header,))
         url, rel = match.groups()
@@ -179,6 +1332,141 @@ def parse_link_header(header):
     return links
 
 
+def decode_search_page(body, fields=None):
+    """
+    Decodes a page of search results straight from the bytes of its body,
+    into a RepositoryInfo per result. Given `fields`, each result is instead
+    just a tuple of those fields, which is much cheaper when pages are only
+    being analysed; a dotted field such as 'owner.login' reaches into nested
+    objects, and missing fields are None.
+
+    >>> body = (b'{"items": [{"name": "dev", "stargazers_count": 28,'
+    ...         b' "owner": {"login": "eddieantonio"}}]}')
+    >>> [str(repo) for repo in decode_search_page(body)]
+    ['eddieantonio/dev']
+    >>> decode_search_page(body, ('stargazers_count', 'parent.full_name'))
+    [(28, None)]
+    >>> [str(login) for login, in decode_search_page(body, ['owner.login'])]
+    ['eddieantonio']
+    """
+    items = json.loads(body.decode('utf-8'))['items']
+    if fields is None:
+        return [RepositoryInfo.from_json(item) for item in items]
+    project = projection(fields)
+    return [project(item) for item in items]
+
+
+def projection(fields):
+    """
+    Returns a function that picks the given (possibly dotted) fields out of
+    a decoded JSON object, as a tuple.
+
+    >>> project = projection(['name', 'owner.login', 'owner.type'])
+    >>> project({'name': 'x', 'owner': {'login': 'y'}, 'size': 3})
+    ('x', 'y', None)
+    >>> project({'owner': None})
+    (None, None, None)
+    """
+    paths = [field.split('.') for field in fields]
+    if all(len(path) == 1 for path in paths):
+        keys = [key for key, in paths]
+        return lambda item: tuple([item.get(key) for key in keys])
+
+    def project(item):
+        values = []
+        for path in paths:
+            value = item
+            for key in path:
+                value = value.get(key) if value else None
+            values.append(value)
+        return tuple(values)
+    return project
+
+
+def plan_downloads(index, order=None, workers=1, max_repo_size=None,
+                   max_total_size=None, skip_forks=False):
+    """
+    Decides which repositories to download, and in what order, before
+    downloading any of them. Returns the repositories to download and the
+    ones that were skipped for being too big (or, with `skip_forks`, for
+    being forks).
+
+    Repositories bigger than `max_repo_size` bytes are skipped, as is any
+    repository that would push the corpus past `max_total_size` bytes; the
+    budget goes to repositories in the order they were found. Repositories
+    of unknown size are never skipped.
+
+    `order` is one of:
+
+     * None: keep the order they were found in;
+     * 'most-stars': the most starred repositories first, so that a run
+       that stops early (see Target) has the best of them;
+     * 'largest-first': so that no huge download is left for the very end
+       while every other worker sits idle;
+     * 'bin-pack': spread repositories across `workers` bins of roughly
+       equal total size, and take turns between the bins.
+    """
+    planned, skipped = [], []
+    total_size = 0
+    for repo in index:
+        size = repo.size_in_bytes or 0
+        if skip_forks and repo.fork:
+            skipped.append(repo)
+        elif max_repo_size is not None and size > max_repo_size:
+            skipped.append(repo)
+        elif max_total_size is not None and total_size + size > max_total_size:
+            skipped.append(repo)
+        else:
+            total_size += size
+            planned.append(repo)
+
+    if order == 'most-stars':
+        planned.sort(key=lambda repo: repo.stars or 0, reverse=True)
+    elif order == 'largest-first':
+        planned.sort(key=lambda repo: repo.size or 0, reverse=True)
+    elif order == 'bin-pack':
+        bins = bin_pack(planned, workers)
+        planned = [repo for turn in map_longest(bins) for repo in turn
+                   if repo is not None]
+    elif order is not None:
+        raise ValueError('Unknown download order: %r' % (order,))
+
+    return planned, skipped
+
+
+def bin_pack(repos, bins):
+    """
+    Splits the repositories into the given number of bins, such that every
+    bin has about the same total size, by putting the next biggest
+    repository in the emptiest bin.
+
+    >>> sizes = [RepositoryInfo('o', str(n), size=n) for n in (8, 1, 5, 4, 3)]
+    >>> [[repo.size for repo in b] for b in bin_pack(sizes, 2)]
+    [[8, 3], [5, 4, 1]]
+    """
+    packed = [[] for _ in range(bins)]
+    # Min-heap of (total size so far, bin number).
+    heap = [(0, n) for n in range(bins)]
+    for repo in sorted(repos, key=lambda repo: repo.size or 0, reverse=True):
+        total, n = heapq.heappop(heap)
+        packed[n].append(repo)
+        heapq.heappush(heap, (total + (repo.size or 0), n))
+    return packed
+
+
+def map_longest(lists):
+    """
+    Zips lists of different lengths, padding with None.
+
+    >>> list(map_longest([[1, 2, 3], [4]]))
+    [(1, 4), (2, None), (3, None)]
+    """
+    try:
+        return itertools.zip_longest(*lists)
+    except AttributeError:
+        return itertools.izip_longest(*lists)
+
+
 def create_search_url(language, page=1, quantity=100):
     """
     Creates a URL for search repositories based on the language.
@@ -212,7 +1500,7 @@ def create_archive_url(owner, repository, release="master"):
 
 
 def create_github_request(url):
-    request = Request(url)
+    request = web().Request(url)
     request.add_header('Accept', 'application/vnd.github.v3+json')
 
     # Add authorization header...
@@ -225,13 +1513,100 @@ def create_github_request(url):
     return request
 
 
-def syntax_ok(contents):
-    r"""
-    Given a source file, returns True if the file compiles.
+def is_transient(error):
+    """
+    Returns True if the error might go away if we just ask again.
 
-    >>> syntax_ok('print("Hello, World!")')
+    >>> import socket
+    >>> is_transient(socket.timeout('timed out'))
     True
-    >>> syntax_ok('import java.util.*;')
+    >>> HTTPError = web().HTTPError
+    >>> is_transient(HTTPError('https://github.com', 503, 'Busy', {}, None))
+    True
+    >>> is_transient(HTTPError('https://github.com', 404, 'Nope', {}, None))
+    False
+    >>> is_transient(NotRecorded('Not recorded: GET https://github.com'))
+    False
+    """
+    if isinstance(error, web().HTTPError):
+        return error.code in RETRY_STATUSES
+    if isinstance(error, NotRecorded):
+        return False
+    return isinstance(error, network_errors())
+
+
+def classify_content(contents):
+    r"""
+    Cheaply decides whether a file could possibly be source code. Returns
+    None if so, otherwise the reason it was rejected.
+
+    >>> classify_content(b'print("Hello, World!")') is None
+    True
+    >>> classify_content(b'\x89PNG\x0D\x0A\x1A\x0A\x00\x00\x00\x0D')
+    'magic:png'
+    >>> classify_content(b'HELLO\x00\x00\x00')
+    'nul-bytes'
+    >>> classify_content(b'name = "Andr\xe9"')
+    'encoding'
+    >>> classify_content(b'# coding: latin-1\nname = "Andr\xe9"') is None
+    True
+    """
+    head = contents[:SNIFF_SIZE]
+    reason = sniff(head)
+    if reason is not None:
+        return reason
+
+    try:
+        contents.decode(declared_encoding(head))
+    except (LookupError, UnicodeDecodeError):
+        return 'encoding'
+
+    return None
+
+
+def sniff(head):
+    """
+    Decides from just the first SNIFF_SIZE bytes of a file whether it's
+    binary. Returns None if it's not, otherwise the reason it was rejected.
+    """
+    if not head:
+        return 'empty'
+    for magic, kind in MAGIC_NUMBERS:
+        if head.startswith(magic):
+            return 'magic:' + kind
+    if b'\x00' in head:
+        return 'nul-bytes'
+    return None
+
+
+def declared_encoding(head):
+    r"""
+    Returns the encoding a source file declares, or else UTF-8. The
+    encoding can only be declared on the first two lines.
+
+    >>> str(declared_encoding(b'#!/usr/bin/env python\n# coding: latin-1\n'))
+    'latin-1'
+    >>> declared_encoding(b'print("Hello, World!")')
+    'utf-8-sig'
+    """
+    for line in head.split(b'\n', 2)[:2]:
+        match = CODING_DECLARATION.match(line)
+        if match:
+            return match.group(1).decode('ascii')
+    return 'utf-8-sig'
+
+
+def syntax_ok(contents, fork=True):
+    r"""
+    Given a source file, returns True if the file compiles.
+
+    Compiling happens in a child process, unless `fork` is False. Forking a
+    process that has other threads running can deadlock the child, so
+    threads shouldn't fork.
+
+    >>> syntax_ok('print("Hello, World!")')
+    True
+    >>> syntax_ok('import java.util.*;')
     False
     >>> syntax_ok('\x89PNG\x0D\x0A\x1A\x0A\x00\x00\x00\x0D')
     False
@@ -244,10 +1619,21 @@ def syntax_ok(contents):
     # leak, I implemented this batshit crazy technique. Basically, let the
     # operating system be our garbage collector.
 
+    if not fork:
+        if isinstance(contents, SpilledFile):
+            contents = contents.read()
+        try:
+            compile(contents, '<unknown>', 'exec')
+        except Exception:
+            return False
+        return True
+
     pid = os.fork()
     if pid == 0:
         # Child process. Let it crash!!!
         try:
+            if isinstance(contents, SpilledFile):
+                contents = contents.read()
             compile(contents, '<unknown>', 'exec')
         except:
             # Use _exit so it doesn't raise a SystemExit exception.
@@ -275,28 +1661,466 @@ def mkdirp(*dirs):
     return fullpath
 
 
-def download_repo_zip(repo):
+def download_repo_zip(repo, retry=None, staging_dir=None):
+    """
+    Downloads the repository's archive into the staging directory (by
+    default, the system's temporary directory) and opens it. Retries pick up
+    from wherever the last attempt left off. It's up to the caller to delete
+    the archive once they're done with it.
+    """
+    import tempfile
+    retry = retry or RetryPolicy()
     url = repo.archive_url
+    path = os.path.join(staging_dir or tempfile.gettempdir(),
+                        '{0}-{1}.zip'.format(repo.owner, repo.name))
     logger.info("Downloading %s...", url)
-    request = create_github_request(url)
     try:
-        response = urlopen(request)
-    except HTTPError:
+        return retry.call(fetch_zip, url, path, retry.timeout)
+    except network_errors():
         logger.exception("Download failed: %s", url)
         return None
 
-    assert response.info()['Content-Type'] == 'application/zip'
 
-    # Need to create a "real" file-like object for ZipFile...
-    file_like = io.BytesIO(response.read())
+def fetch_zip(url, path, timeout=None):
+    """
+    Downloads the zip at the URL to the given path in one attempt.
 
-    return zipfile.ZipFile(file_like, allowZip64=True)
+    Bytes are written to `path + '.part'` as they arrive. If that file is
+    already there, only the rest of the archive is requested, using a Range
+    request, and the server is free to ignore it and send the whole thing.
+    The archive is only moved to `path` once it's known to be complete.
+    """
+    import shutil
+    import zipfile
+    partial = path + '.part'
+    etag_path = partial + '.etag'
+
+    offset = os.path.getsize(partial) if os.path.exists(partial) else 0
+    request = create_github_request(url)
+    if offset:
+        request.add_header('Range', 'bytes={0:d}-'.format(offset))
+        # Make sure the rest is from the same archive we started with!
+        if os.path.exists(etag_path):
+            with open(etag_path) as f:
+                request.add_header('If-Range', f.read())
+
+    try:
+        response = web().urlopen(request, timeout=timeout)
+    except web().HTTPError as error:
+        if error.code != 416 or not offset:
+            raise
+        # The partial file is no good for this archive; start from scratch.
+        os.remove(partial)
+        raise IncompleteDownload('Could not resume {0}'.format(url))
+    headers = response.info()
+
+    assert headers['Content-Type'] == 'application/zip'
+
+    start, expected_size = parse_content_range(headers.get('Content-Range'))
+    if response.getcode() != 206 or start != offset:
+        # Got the entire archive back; start over.
+        offset, expected_size = 0, None
+    if expected_size is None and headers.get('Content-Length'):
+        expected_size = offset + int(headers['Content-Length'])
+
+    if headers.get('ETag'):
+        with open(etag_path, 'w') as f:
+            f.write(headers['ETag'])
+
+    with open(partial, 'ab' if offset else 'wb') as f:
+        shutil.copyfileobj(response, f, CHUNK_SIZE)
+
+    actual_size = os.path.getsize(partial)
+    if expected_size is not None and actual_size != expected_size:
+        if actual_size > expected_size:
+            # Somehow got more than we bargained for. Can't trust any of it.
+            os.remove(partial)
+        raise IncompleteDownload('Got {0:d} of {1:d} bytes of {2}'.format(
+            actual_size, expected_size, url))
+
+    os.rename(partial, path)
+    if os.path.exists(etag_path):
+        os.remove(etag_path)
+
+    return zipfile.ZipFile(path, allowZip64=True)
+
+
+def parse_content_range(header):
+    """
+    Parses the content of a Content-Range: header, returning the offset of
+    the first byte and the size of the entire resource.
+
+    >>> parse_content_range('bytes 1024-3174/3175')
+    (1024, 3175)
+    >>> parse_content_range('bytes 1024-3174/*')
+    (1024, None)
+    >>> parse_content_range(None)
+    (None, None)
+    """
+    match = re.match(r'bytes\s+(\d+)-\d+/(\d+|\*)', header or '')
+    if not match:
+        return None, None
+    start, size = match.groups()
+    return int(start), (int(size) if size != '*' else None)
+
+
+class ZipSnapshot(object):
+
+    """
+    A repository's files, in a zip archive on disk.
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def members(self):
+        """
+        Returns the archive's files, mapped to their CRC and size, straight
+        from the zip's central directory.
+        """
+        import zipfile
+        with zipfile.ZipFile(self.path, allowZip64=True) as archive:
+            return collections.OrderedDict(
+                (info.filename, {'crc': info.CRC, 'size': info.file_size})
+                for info in archive.infolist()
+                if not info.filename.endswith('/'))
+
+    def fingerprint(self):
+        """
+        Returns a hash of the names and CRCs of every file in the archive,
+        straight from the zip's central directory, so nothing needs to be
+        inflated. The archive's top-level directory, named after the
+        repository, is left out, so mirrors have the same fingerprint.
+        """
+        import hashlib
+        import zipfile
+        with zipfile.ZipFile(self.path, allowZip64=True) as archive:
+            entries = sorted('{0} {1:08x}'.format(
+                info.filename.split('/', 1)[-1], info.CRC)
+                for info in archive.infolist()
+                if not info.filename.endswith('/'))
+        return hashlib.sha1('\n'.join(entries).encode('utf-8')).hexdigest()
+
+    def open(self):
+        """
+        Returns a reader for the files' contents. Readers have a read(name)
+        method for a file's whole contents, an open(name) method for a
+        file-like object to read it bit by bit, an order(names) method that
+        puts names in the order that's quickest to read them in, and a
+        close() method.
+        """
+        return ZipReader(self.path)
+
+    def remove(self):
+        os.remove(self.path)
+
+
+class ZipReader(object):
+
+    """
+    Reads files from a ZipSnapshot.
+    """
+
+    def __init__(self, path):
+        import zipfile
+        self.archive = zipfile.ZipFile(path, allowZip64=True)
+
+    def read(self, name):
+        return self.archive.read(name)
+
+    def open(self, name):
+        return self.archive.open(name)
+
+    def order(self, names):
+        """
+        Sorts names by where the files are in the archive, so it's read
+        from start to end.
+        """
+        getinfo = self.archive.getinfo
+        return sorted(names, key=lambda name: getinfo(name).header_offset)
+
+    def close(self):
+        self.archive.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class ZipBackend(object):
+
+    """
+    Fetches repositories as zip archives of their default branch.
+    """
+
+    def __init__(self, retry=None):
+        self.retry = retry or RetryPolicy()
+
+    def fetch(self, repo, staging_dir):
+        """
+        Returns a snapshot of the repository's files, or None if they could
+        not be fetched.
+        """
+        archive = download_repo_zip(repo, self.retry, staging_dir)
+        if not archive:
+            return None
+        archive.close()
+        return ZipSnapshot(archive.filename)
+
+
+class GitSnapshot(object):
+
+    """
+    A repository's files, as of a commit in a local bare repository.
+
+    Files are named as in GitHub's archives: within a directory named after
+    the repository and its branch.
+    """
+
+    def __init__(self, git_dir, commit, prefix, git='git'):
+        self.git_dir = git_dir
+        self.commit = commit
+        self.prefix = prefix
+        self.git = git
+
+    def members(self):
+        """
+        Returns the commit's files, mapped to their blob's hash and size.
+        """
+        import subprocess
+        output = subprocess.check_output([
+            self.git, '--git-dir', self.git_dir,
+            'ls-tree', '-r', '-l', '-z', self.commit])
+        members = collections.OrderedDict()
+        for entry in output.split(b'\0'):
+            if not entry:
+                continue
+            info, path = entry.split(b'\t', 1)
+            _mode, kind, sha, size = info.split()
+            if kind == b'blob':
+                members[self.prefix + native_str(path)] = {
+                    'sha': native_str(sha), 'size': int(size)}
+        return members
+
+    def fingerprint(self):
+        """
+        Returns the hash of the commit's tree, which is the same for any
+        repository with exactly the same files.
+        """
+        import subprocess
+        return native_str(subprocess.check_output([
+            self.git, '--git-dir', self.git_dir,
+            'rev-parse', self.commit + '^{tree}'])).strip()
+
+    def open(self):
+        return GitReader(self)
+
+    def remove(self):
+        # Keep the repository around, so the next fetch is just a delta.
+        pass
+
+
+class GitReader(object):
+
+    """
+    Reads files from a GitSnapshot through one long-running
+    `git cat-file --batch`.
+    """
+
+    def __init__(self, snapshot):
+        import subprocess
+        self.snapshot = snapshot
+        self.process = subprocess.Popen([
+            snapshot.git, '--git-dir', snapshot.git_dir,
+            'cat-file', '--batch'],
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+
+    def read(self, name):
+        with self.open(name) as blob:
+            return blob.read()
+
+    def open(self, name):
+        """
+        Returns a file-like object for the file. It has to be closed before
+        the next file is opened.
+        """
+        path = name[len(self.snapshot.prefix):]
+        request = '{0}:{1}\n'.format(self.snapshot.commit, path)
+        self.process.stdin.write(request.encode('utf-8'))
+        self.process.stdin.flush()
+
+        header = self.process.stdout.readline().split()
+        if header[-1] == b'missing':
+            raise KeyError(name)
+        return GitBlob(self.process.stdout, int(header[2]))
+
+    def order(self, names):
+        # cat-file can look up objects in any order.
+        return names
+
+    def close(self):
+        self.process.stdin.close()
+        self.process.stdout.close()
+        self.process.wait()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class GitBlob(object):
+
+    """
+    One file's contents, in the middle of the output of `git cat-file`.
+    """
+
+    def __init__(self, stream, size):
+        self.stream = stream
+        self.remaining = size
+
+    def read(self, size=-1):
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.stream.read(size)
+        self.remaining -= len(data)
+        return data
+
+    def close(self):
+        while self.remaining:
+            if not self.read(CHUNK_SIZE):
+                break
+        # Each object is followed by a newline.
+        self.stream.read(1)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class GitBackend(object):
+
+    """
+    Fetches repositories with a local `git`, as shallow fetches of their
+    default branch into bare repositories kept in the staging directory.
+    Fetching a repository again only transfers what changed since.
+
+    Repositories are fetched from `base_url`/owner/name.git, where
+    `base_url` can be anything `git fetch` understands, including a local
+    directory.
+
+    git never prompts for credentials (a deleted or private repository
+    just fails), and is killed if it takes more than `timeout` seconds.
+    Failed fetches are retried according to the `retry` policy.
+    """
+
+    def __init__(self, base_url=GITHUB_BASE, git='git', retry=None,
+                 timeout=GIT_TIMEOUT):
+        self.base_url = base_url
+        self.git = git
+        self.retry = retry or RetryPolicy()
+        self.timeout = timeout
+
+    def fetch(self, repo, staging_dir):
+        url = '{0}/{1}/{2}.git'.format(self.base_url, repo.owner, repo.name)
+        # Anything starting with a dash would be taken for an option.
+        if repo.default_branch.startswith('-'):
+            logger.error("Not fetching %s: bad branch name %r", url,
+                         repo.default_branch)
+            return None
+        git_dir = os.path.join(staging_dir, 'git', repo.owner,
+                               repo.name + '.git')
+        logger.info("Fetching %s...", url)
+        try:
+            if not os.path.exists(git_dir):
+                mkdirp(git_dir)
+                run_git([self.git, 'init', '--quiet', '--bare', git_dir])
+            self.retry.call(run_git, [self.git, '--git-dir', git_dir,
+                                      'fetch', '--quiet', '--depth=1', '--',
+                                      url, repo.default_branch],
+                            self.timeout)
+            commit = run_git([self.git, '--git-dir', git_dir,
+                              'rev-parse', 'FETCH_HEAD'])
+        except GitFailed:
+            logger.exception("Fetch failed: %s", url)
+            return None
+
+        prefix = '{0}-{1}/'.format(repo.name, repo.default_branch)
+        return GitSnapshot(git_dir, native_str(commit).strip(), prefix,
+                           self.git)
+
+
+# Ways to fetch repositories, by name.
+BACKENDS = {'zip': ZipBackend, 'git': GitBackend}
+
+
+def run_git(args, timeout=None):
+    """
+    Runs a git command, without ever letting it prompt for anything, and
+    returns what it printed. Raises GitFailed if it can't be run, exits
+    with an error, or is still running after `timeout` seconds.
+    """
+    import subprocess
+    env = dict(os.environ, GIT_TERMINAL_PROMPT='0')
+    try:
+        process = subprocess.Popen(args, stdout=subprocess.PIPE, env=env)
+    except OSError as error:
+        raise GitFailed('Could not run {0}: {1}'.format(args[0], error))
+
+    killed = []
+
+    def kill():
+        killed.append(True)
+        try:
+            process.kill()
+        except OSError:
+            pass
+    timer = None
+    if timeout is not None:
+        timer = threading.Timer(timeout, kill)
+        timer.daemon = True
+        timer.start()
+    try:
+        output = process.communicate()[0]
+    finally:
+        if timer:
+            timer.cancel()
+    if killed:
+        raise GitFailed('{0} took more than {1} seconds'.format(
+            ' '.join(args), timeout))
+    if process.returncode != 0:
+        raise GitFailed('{0} exited with status {1:d}'.format(
+            ' '.join(args), process.returncode))
+    return output
+
+
+def native_str(data):
+    """
+    Returns bytes from a subprocess as the native str type.
+    """
+    if isinstance(data, str):
+        return data
+    return data.decode('utf-8')
 
 
 def maybe_write_file(directory, file_path, file_content):
     if not file_content or not syntax_ok(file_content):
         return False
 
+    write_file(directory, file_path, file_content)
+    return True
+
+
+def write_file(directory, file_path, file_content):
+    """
+    Writes a file from the archive to the directory, dropping the archive's
+    top-level directory.
+    """
     zip_path = file_path.split(os.sep)
 
     assert len(zip_path) >= 2
@@ -309,66 +2133,1898 @@ def maybe_write_file(directory, file_path, file_content):
 
     logger.debug('Writing %s...', file_path)
     logger.debug('Its zip path %s...', zip_path)
+    if isinstance(file_content, SpilledFile):
+        # Already on disk; just move it into place.
+        os.rename(file_content.path, file_path)
+        return '/'.join(zip_path[1:])
+
     with open(file_path, 'wb') as f:
         f.write(file_content)
 
-    return True
+    return '/'.join(zip_path[1:])
 
 
-def download_repo(repo, directory, language="python"):
+def sync_path(path):
     """
-    Downloads a repository and keeps only the files that validly compile.
+    Flushes a file or directory to disk.
+    """
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    except OSError:
+        # Not every platform can fsync a directory.
+        if not os.path.isdir(path):
+            raise
+    finally:
+        os.close(fd)
+
+
+def sync_tree(directory):
+    """
+    Flushes every file and directory within the directory to disk.
+    """
+    for dirpath, _dirnames, filenames in os.walk(directory):
+        for filename in filenames:
+            sync_path(os.path.join(dirpath, filename))
+        sync_path(dirpath)
+
+
+def relative_path(filename):
+    """
+    Returns the path of a file from an archive within the repository's
+    directory.
+
+    >>> relative_path('ghdwn-master/mock_data/__init__.py')
+    'mock_data/__init__.py'
+    """
+    return filename.split('/', 1)[-1]
+
+
+def same_checksum(info, checksum):
+    """
+    Whether a file's info from a manifest has the same checksum and size
+    as a snapshot's member.
+
+    >>> same_checksum({'crc': 1, 'size': 5, 'lines': 1},
+    ...               {'crc': 1, 'size': 5})
+    True
+    >>> same_checksum({'crc': 1, 'size': 5}, {'crc': 2, 'size': 5})
+    False
+    >>> same_checksum(None, {'crc': 1, 'size': 5})
+    False
+    """
+    return info is not None and all(info.get(key) == value
+                                    for key, value in checksum.items())
+
+
+def batches(iterable, size=BATCH_SIZE, max_bytes=None, sizeof=len):
+    """
+    Splits an iterable into lists of at most `size` items. Given
+    `max_bytes`, batches are also cut short before their items' total
+    sizeof() goes over it; an item that is bigger on its own gets a batch
+    all to itself.
+
+    >>> list(batches(range(5), 2))
+    [[0, 1], [2, 3], [4]]
+    >>> list(batches(['a', 'bcd', 'ef', 'g'], max_bytes=3))
+    [['a'], ['bcd'], ['ef', 'g']]
+    """
+    batch, total = [], 0
+    for item in iterable:
+        item_size = sizeof(item) if max_bytes is not None else 0
+        if batch and (len(batch) >= size or
+                      max_bytes is not None and
+                      total + item_size > max_bytes):
+            yield batch
+            batch, total = [], 0
+        batch.append(item)
+        total += item_size
+    if batch:
+        yield batch
+
+
+def parse_size(text):
+    """
+    Parses an amount of memory, like 512M or 2G, into bytes.
+
+    >>> parse_size('2G') == 2 * 1024 ** 3
+    True
+    >>> parse_size('1500')
+    1500
+    """
+    units = 'KMGT'
+    text = text.strip().upper().rstrip('B')
+    if text and text[-1] in units:
+        return int(float(text[:-1]) * 1024 ** (units.index(text[-1]) + 1))
+    return int(text)
+
+
+def parse_duration(text):
+    """
+    Parses an amount of time, like 90s, 45m or 1.5h, into seconds.
+
+    >>> parse_duration('1.5h'), parse_duration('45m'), parse_duration('90')
+    (5400.0, 2700.0, 90.0)
+    """
+    units = {'s': 1, 'm': 60, 'h': 60 * 60, 'd': 24 * 60 * 60}
+    text = text.strip().lower()
+    if text and text[-1] in units:
+        return float(text[:-1]) * units[text[-1]]
+    return float(text)
+
+
+class SpilledFile(object):
+
+    """
+    A file that was too big to keep in memory between validating and
+    writing it, so it waits on disk instead.
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def read(self):
+        with open(self.path, 'rb') as f:
+            return f.read()
+
+    def remove(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+def validate_batch(job):
+    """
+    Reads a batch of files from a snapshot of a repository (see ZipBackend
+    and GitBackend) and returns (filename, content, info) for the ones that
+    compile, along with how many were rejected for each reason.
+
+    Takes a single (snapshot, filenames[, options]) tuple so that it can be
+    handed straight to Pool.imap_unordered(). Each worker opens the
+    snapshot itself, so nothing but where to find it and the file names is
+    sent its way. The options are a dict; if 'metrics' is set, each file's
+    info includes its file_metrics() in the given 'language', and if
+    'minhash' is set, its 'minhash' signature. Files bigger than
+    'spill_size' are streamed to SpilledFiles in the 'spill_dir', rather
+    than read into memory. If 'fork' is False, files are compiled without
+    forking (see syntax_ok).
+
+    Files are read in the order they're stored in, a chunk at a time, and
+    binary files are rejected as soon as their first chunk is sniffed.
+    """
+    snapshot, filenames = job[:2]
+    options = job[2] if len(job) > 2 else {}
+    accepted = []
+    rejected = collections.defaultdict(int)
+    with snapshot.open() as archive:
+        for filename in archive.order(filenames):
+            if filename.endswith('/'):
+                # Directories aren't worth mentioning.
+                continue
+            with archive.open(filename) as member:
+                reason, content = read_member(member, options)
+            if reason is None and not syntax_ok(content,
+                                                options.get('fork', True)):
+                reason = 'syntax'
+            if reason is not None:
+                rejected[reason] += 1
+                if isinstance(content, SpilledFile):
+                    content.remove()
+                continue
+
+            info = {}
+            if options.get('metrics') or options.get('minhash'):
+                # Measuring a spilled file means reading it back in, but
+                # only for as long as it takes to measure it.
+                whole = content
+                if isinstance(content, SpilledFile):
+                    whole = content.read()
+                if options.get('metrics'):
+                    info.update(file_metrics(
+                        whole, options.get('language', 'python')))
+                if options.get('minhash'):
+                    info['minhash'] = minhash_signature(whole)
+                del whole
+            accepted.append((filename, content, info))
+    return accepted, dict(rejected)
+
+
+def read_member(member, options):
+    """
+    Reads a file from a snapshot a chunk at a time, checking it as it goes
+    (see classify_content). Returns (reason, content), where the reason is
+    None unless the file was rejected. Once it's bigger than the options'
+    'spill_size', the content goes to a SpilledFile instead of memory.
     """
-    base_dir = mkdirp(directory, repo.owner, repo.name)
+    import tempfile
+    head = member.read(SNIFF_SIZE)
+    reason = sniff(head)
+    if reason is not None:
+        return reason, None
 
-    archive = download_repo_zip(repo)
+    try:
+        decoder = codecs.getincrementaldecoder(declared_encoding(head))()
+    except LookupError:
+        return 'encoding', None
+
+    spill_size = options.get('spill_size')
+    chunks, size, spilled, spill = [], 0, None, None
+    try:
+        chunk = head
+        while chunk:
+            decoder.decode(chunk)
+            size += len(chunk)
+            if spill is None and spill_size and size > spill_size:
+                fd, path = tempfile.mkstemp(dir=options['spill_dir'],
+                                            suffix='.spill')
+                spilled, spill = SpilledFile(path), os.fdopen(fd, 'wb')
+                spill.writelines(chunks)
+                chunks = []
+            if spill is not None:
+                spill.write(chunk)
+            else:
+                chunks.append(chunk)
+            chunk = member.read(CHUNK_SIZE)
+        decoder.decode(b'', True)
+    except UnicodeDecodeError:
+        if spilled is not None:
+            spill.close()
+            spilled.remove()
+        return 'encoding', None
+
+    if spill is not None:
+        spill.close()
+        return None, spilled
+    return None, b''.join(chunks)
+
+
+def file_metrics(content, language='python'):
+    r"""
+    Measures a source file. Python files are tokenized properly; anything
+    else is just split into words and punctuation.
 
-    if not archive:
-        logger.error('Could not download archive for %s', repo)
-        return
+    >>> sorted(file_metrics(b'x = 1\nprint(x)\n').items())
+    [('bytes', 15), ('lines', 2), ('tokens', 7)]
+    >>> file_metrics(b'int x = 1;', 'c')['tokens']
+    5
+    """
+    lines = content.count(b'\n')
+    if content and not content.endswith(b'\n'):
+        lines += 1
+
+    tokens = None
+    if language == 'python':
+        readline = io.BytesIO(content).readline
+        if sys.version_info[0] >= 3:
+            token_stream = tokenize.tokenize(readline)
+        else:
+            token_stream = tokenize.generate_tokens(readline)
+        try:
+            tokens = sum(1 for token in token_stream
+                         if token[0] not in LAYOUT_TOKENS)
+        except (tokenize.TokenError, SyntaxError):
+            pass
+    if tokens is None:
+        tokens = len(GENERIC_TOKEN.findall(content))
 
-    for filename in archive.namelist():
-        content = archive.open(filename).read()
-        maybe_write_file(base_dir, filename, content)
+    return {'bytes': len(content), 'lines': lines, 'tokens': tokens}
 
 
-def download_corpus(language, directory, quantity=1024):
+def minhash_signature(content, size=MINHASH_SIZE, shingle_size=SHINGLE_SIZE):
     """
-    Downloads a corpus to the given directory.
+    Computes a MinHash signature of the file's shingles (runs of
+    consecutive tokens). The fraction of values two signatures have in
+    common estimates how similar the files are (see similarity). Returns
+    None if the file has no tokens at all.
+
+    Rather than hash every shingle `size` times, this uses one-permutation
+    hashing: each shingle is hashed once, the hash picks which of the
+    `size` values it competes for, and values nothing landed on borrow
+    from the next value over. That's O(shingles), not O(size * shingles),
+    which matters when this runs on every file in the corpus.
+
+    >>> original = b' '.join(b'x%d = %d' % (n, n) for n in range(40))
+    >>> edited = original.replace(b'x20 = 20', b'x20 = 21')
+    >>> similarity(minhash_signature(original),
+    ...            minhash_signature(edited)) > 0.8
+    True
+    >>> minhash_signature(b'') is None
+    True
     """
+    import hashlib
+    tokens = GENERIC_TOKEN.findall(content)
+    if not tokens:
+        return None
 
+    signature = [None] * size
+    for start in range(max(1, len(tokens) - shingle_size + 1)):
+        shingle = b' '.join(tokens[start:start + shingle_size])
+        value, = struct.unpack('<Q', hashlib.md5(shingle).digest()[:8])
+        bucket, value = value % size, value // size
+        if signature[bucket] is None or value < signature[bucket]:
+            signature[bucket] = value
+
+    # Fill in the empty values from the next non-empty one, offset by how
+    # far away it is, so that the same gaps get the same values.
+    stride = 2 ** 64 // size
+    densified = list(signature)
+    for bucket in range(size):
+        distance = 0
+        while signature[(bucket + distance) % size] is None:
+            distance += 1
+        densified[bucket] = (signature[(bucket + distance) % size] +
+                             distance * stride)
+    return densified
+
+
+def similarity(signature, other):
+    """
+    Estimates how similar two files are from their MinHash signatures.
+
+    >>> similarity([1, 2, 3, 4], [1, 2, 3, 5])
+    0.75
+    """
+    same = sum(1 for mine, theirs in zip(signature, other) if mine == theirs)
+    return same / float(len(signature))
+
+
+class Pipeline(object):
+
+    """
+    A chain of stages joined by bounded queues.
+
+    Each stage is a function that takes one item and returns (or yields) any
+    number of items for the next stage, and is run by its own bunch of
+    threads. Since the queues are bounded, a stage that falls behind makes
+    the stages before it wait, instead of letting work pile up in memory.
+
+    The metrics keep track of how long each stage's queue is, how many
+    items each stage is working on, and how long each item takes, including
+    any time spent waiting for the next stage to make room.
+
+    >>> pipeline = Pipeline(queue_size=2)
+    >>> pipeline.add_stage('double', lambda n: [n, n], workers=2)
+    >>> squares = []
+    >>> pipeline.add_stage('square', lambda n: squares.append(n * n))
+    >>> pipeline.run(range(4))
+    >>> sorted(squares)
+    [0, 0, 1, 1, 4, 4, 9, 9]
+    """
+
+    # Tells a worker to stop.
+    DONE = object()
+
+    def __init__(self, queue_size=QUEUE_SIZE):
+        self.queue_size = queue_size
+        self.stages = []
+
+    def add_stage(self, name, function, workers=1):
+        inbox = queue.Queue(self.queue_size)
+        self.stages.append((name, function, workers, inbox))
+
+    def run(self, items):
+        """
+        Feeds the items through every stage, and returns once they've all
+        come out the other end.
+        """
+        outboxes = [stage[3] for stage in self.stages[1:]] + [None]
+
+        threads = []
+        for (name, function, workers, inbox), outbox in zip(self.stages,
+                                                            outboxes):
+            live_metrics.watch('ghdwn_queue_length', inbox.qsize,
+                               stage=name)
+            stage_threads = []
+            for n in range(workers):
+                thread = threading.Thread(target=self.work,
+                                          name='{0}-{1:d}'.format(name, n),
+                                          args=(name, function, inbox, outbox))
+                thread.daemon = True
+                thread.start()
+                stage_threads.append(thread)
+            threads.append(stage_threads)
+
+        first_inbox = self.stages[0][3]
+        for item in items:
+            first_inbox.put(item)
+
+        # Shut each stage down once everything before it has finished.
+        for (_, _, _, inbox), stage_threads in zip(self.stages, threads):
+            for _ in stage_threads:
+                inbox.put(self.DONE)
+            for thread in stage_threads:
+                thread.join()
+
+    def work(self, name, function, inbox, outbox):
+        while True:
+            item = inbox.get()
+            if item is self.DONE:
+                return
+            live_metrics.add('ghdwn_stage_in_progress', 1, 'gauge',
+                             stage=name)
+            start = time.time()
+            try:
+                for result in function(item) or ():
+                    if outbox is not None:
+                        outbox.put(result)
+            except Exception:
+                logger.exception('%s failed on %r', name, item)
+            finally:
+                live_metrics.observe('ghdwn_stage_seconds',
+                                     time.time() - start, stage=name)
+                live_metrics.add('ghdwn_stage_in_progress', -1, 'gauge',
+                                 stage=name)
+
+
+class MemoryBudget(object):
+
+    """
+    Limits how many bytes of file contents are held in memory at once,
+    across every repository in flight.
+
+    Reserving blocks until enough has been released. Reserving more than
+    the whole budget only waits until nothing else is reserved, so it
+    can't wait forever.
+
+    >>> budget = MemoryBudget(100)
+    >>> budget.reserve(60); budget.reserve(40); budget.reserved
+    100
+    >>> budget.release(60); budget.reserved
+    40
+    """
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.reserved = 0
+        self.condition = threading.Condition()
+
+    def reserve(self, amount):
+        with self.condition:
+            while self.reserved and self.reserved + amount > self.limit:
+                self.condition.wait()
+            self.reserved += amount
+
+    def release(self, amount):
+        with self.condition:
+            self.reserved -= amount
+            self.condition.notify_all()
+
+
+class Target(object):
+
+    """
+    How much corpus is enough: a number of files, a number of bytes of
+    files, and/or a number of seconds from now to stop at, whichever comes
+    first. Counts only go up a whole repository at a time.
+
+    >>> target = Target(files=10, size=1000)
+    >>> target.add(6, 600); target.reached()
+    False
+    >>> target.add(4, 100); target.reached()
+    True
+    >>> Target(seconds=0).reached()
+    True
+    """
+
+    def __init__(self, files=None, size=None, seconds=None):
+        self.files = files
+        self.size = size
+        self.deadline = time.time() + seconds if seconds is not None else None
+        self.files_so_far = 0
+        self.size_so_far = 0
+        self.lock = threading.Lock()
+
+    def add(self, files, size):
+        with self.lock:
+            self.files_so_far += files
+            self.size_so_far += size
+
+    def time_left(self):
+        """
+        Returns how many seconds are left until the deadline, or None if
+        there isn't one.
+        """
+        if self.deadline is None:
+            return None
+        return max(0, self.deadline - time.time())
+
+    def reached(self):
+        return ((self.files is not None and
+                 self.files_so_far >= self.files) or
+                (self.size is not None and self.size_so_far >= self.size) or
+                self.time_left() == 0)
+
+
+class GzipCompressor(object):
+
+    """
+    Compresses files in a corpus with gzip.
+
+    >>> compressor = GzipCompressor()
+    >>> content = b'print("Hello, World!")\\n'
+    >>> decompress(compressor.compress(content), '.gz') == content
+    True
+    """
+
+    suffix = '.gz'
+
+    def __init__(self, directory=None, language=None, level=6):
+        self.level = level
+
+    def compress(self, content):
+        import gzip
+        buffer = io.BytesIO()
+        # Leave out the time, so the same file always compresses the same.
+        with gzip.GzipFile(fileobj=buffer, mode='wb', mtime=0,
+                           compresslevel=self.level) as f:
+            f.write(content)
+        return buffer.getvalue()
+
+
+def zstd():
+    """
+    Imports zstandard, which is only needed for zstd-compressed corpora.
+    """
+    try:
+        import zstandard
+    except ImportError:
+        raise ValueError('zstd compression needs the zstandard package')
+    return zstandard
+
+
+class ZstdCompressor(object):
+
+    """
+    Compresses files in a corpus with zstd, using a dictionary trained on
+    the language's files.
+
+    Dictionaries are kept in the corpus directory, named after their
+    language and ID (see DICTIONARY_NAME), so workers sharing a directory
+    never overwrite each other's. If there isn't one yet, the first
+    DICTIONARY_SAMPLES files are compressed without one, and then used to
+    train it.
+    """
+
+    suffix = '.zst'
+
+    def __init__(self, directory, language='python', level=3):
+        import glob
+        zstandard = zstd()
+        self.directory = directory
+        self.language = language
+        self.level = level
+        self.samples = []
+        self.lock = threading.Lock()
+
+        dictionary = None
+        existing = sorted(glob.glob(os.path.join(
+            directory, DICTIONARY_NAME.format(language, '*'))))
+        if existing:
+            with open(existing[0], 'rb') as f:
+                dictionary = zstandard.ZstdCompressionDict(f.read())
+        self.use(dictionary)
+
+    def use(self, dictionary):
+        self.dictionary = dictionary
+        options = {'level': self.level}
+        if dictionary is not None:
+            options['dict_data'] = dictionary
+        self.compressor = zstd().ZstdCompressor(**options)
+
+    def compress(self, content):
+        with self.lock:
+            if self.dictionary is None:
+                self.samples.append(content)
+                if len(self.samples) >= DICTIONARY_SAMPLES:
+                    self.train()
+            return self.compressor.compress(content)
+
+    def train(self):
+        zstandard = zstd()
+        samples, self.samples = self.samples, []
+        try:
+            dictionary = zstandard.train_dictionary(DICTIONARY_SIZE, samples)
+        except zstandard.ZstdError:
+            logger.exception('Could not train a zstd dictionary')
+            return
+        path = os.path.join(self.directory, DICTIONARY_NAME.format(
+            self.language, dictionary.dict_id()))
+        with open(path + '.tmp', 'wb') as f:
+            f.write(dictionary.as_bytes())
+        os.rename(path + '.tmp', path)
+        self.use(dictionary)
+
+
+def decompress(content, suffix, dictionaries=None):
+    """
+    Decompresses a file from a corpus, going by the suffix it was written
+    with. Files written with a zstd dictionary need `dictionaries`: a dict
+    of them by their ID.
+    """
+    import gzip
+    if suffix == GzipCompressor.suffix:
+        with gzip.GzipFile(fileobj=io.BytesIO(content)) as f:
+            return f.read()
+    if suffix == ZstdCompressor.suffix:
+        zstandard = zstd()
+        frame = zstandard.get_frame_parameters(content)
+        options = {}
+        if frame.dict_id:
+            options['dict_data'] = (dictionaries or {})[frame.dict_id]
+        return zstandard.ZstdDecompressor(**options).decompress(content)
+    return content
+
+
+class Extraction(object):
+
+    """
+    A downloaded snapshot of a repository on its way through the pipeline.
+    """
+
+    def __init__(self, repo, snapshot, target_dir):
+        self.repo = repo
+        self.snapshot = snapshot
+        # Files are written to base_dir, which replaces target_dir once
+        # they're all written.
+        self.target_dir = target_dir
+        self.base_dir = None
+        self.files = {}
+        self.carried = set()
+        self.rejected = {}
+        self.members = {}
+        self.pending = 0
+        self.broken = False
+        # The keys of the files indexed as near-duplicate originals.
+        self.indexed = []
+        self.lock = threading.Lock()
+
+    def batch_done(self):
+        """
+        Marks one of the archive's batches as written. Returns True once
+        every batch is done.
+        """
+        with self.lock:
+            self.pending -= 1
+            return self.pending == 0
+
+
+class CorpusBuilder(object):
+
+    """
+    Downloads repositories into a corpus directory.
+
+    Fetching archives, splitting them into batches, validating the batches
+    and writing out the files that pass are separate pipeline stages, so
+    that network I/O, compiling and disk writes all happen at the same time.
+    `workers` overrides how many threads work on each stage (see
+    DEFAULT_WORKERS). If given a multiprocessing pool, validation happens
+    in its processes instead of in the validation threads, which compile
+    files without forking, since the pipeline is multi-threaded. If given a
+    Manifest, every repository is recorded in it once it's written.
+    Repositories are fetched with the given backend (by default, a
+    ZipBackend). With `metrics`, validation also measures every file that
+    passes (see file_metrics), and the manifest records the measurements.
+
+    Repositories with exactly the same files as a repository downloaded
+    before (see ZipSnapshot.fingerprint) are skipped as mirrors.
+
+    `previous` is the manifest of an earlier run (see load_manifest). Files
+    whose checksum and size are the same as last time are neither read,
+    validated nor written again, but simply carried over, and files that
+    are gone are deleted.
+
+    `near_duplicates` is a NearDuplicateIndex shared by every repository.
+    If given, files that nearly duplicate a file already in the corpus are
+    either dropped (if `near_dedup` is 'drop') or written but tagged in the
+    manifest as a 'near_duplicate_of' the original (if it's 'tag').
+
+    If given a `compressor` (see COMPRESSORS), files are written compressed,
+    with its suffix.
+
+    Each repository's files are written to a temporary directory, which
+    takes the place of the repository's directory only once every file has
+    been written, so a repository that is only partly written is never
+    where it's expected to be. `fsync` is one of the FSYNC_POLICIES.
+
+    Given a MemoryBudget, downloads and batches of files wait for room in
+    it before they start. Files too big to fit in a batch of their own
+    (a quarter of the budget) are spilled to disk between validating and
+    writing them.
+
+    Given a Sampler, only the files it samples are kept. Files that can't
+    make the cut are skipped before they're inflated; files evicted from
+    the sample later on are deleted at the end of the run.
+
+    Given a Target, the run is cancelled as soon as it's reached: no more
+    repositories are fetched, and the ones already on their way through
+    the pipeline are thrown away instead of being committed, leaving
+    whatever was there before them. A download that's already underway
+    still runs to the end of its current attempt.
+    """
+
+    def __init__(self, directory, language='python', retry=None, pool=None,
+                 workers=None, queue_size=QUEUE_SIZE, manifest=None,
+                 backend=None, metrics=False, near_duplicates=None,
+                 near_dedup='drop', previous=None, compressor=None,
+                 fsync='none', budget=None, sampler=None, target=None):
+        self.directory = directory
+        self.language = language
+        self.retry = retry or RetryPolicy()
+        self.backend = backend or ZipBackend(self.retry)
+        self.pool = pool
+        self.workers = dict(DEFAULT_WORKERS, **(workers or {}))
+        self.queue_size = queue_size
+        self.manifest = manifest
+        self.metrics = metrics
+        self.near_duplicates = near_duplicates
+        self.near_dedup = near_dedup
+        self.previous = previous or {}
+        self.compressor = compressor
+        self.fsync = fsync
+        self.committed = collections.deque()
+        self.budget = budget
+        self.spill_size = budget.limit // 4 if budget else None
+        self.sampler = sampler
+        self.target = target
+        self.cancelled = threading.Event()
+        self.fingerprints = {}
+        self.lock = threading.Lock()
+        self.failed = collections.deque()
+        self.stats = CorpusStats()
+
+    def run(self, repos):
+        """
+        Downloads all of the repositories. Returns the ones that could not
+        be downloaded.
+        """
+        import multiprocessing
+        self.failed.clear()
+
+        pipeline = Pipeline(self.queue_size)
+        for stage in ('fetch', 'extract', 'validate', 'write'):
+            workers = self.workers[stage] or multiprocessing.cpu_count()
+            pipeline.add_stage(stage, getattr(self, stage), workers)
+
+        timer = None
+        if self.target and self.target.time_left() is not None:
+            timer = threading.Timer(self.target.time_left(), self.cancel)
+            timer.daemon = True
+            timer.start()
+        try:
+            pipeline.run(repos)
+        finally:
+            if timer:
+                timer.cancel()
+
+        if self.sampler:
+            self.evict(self.sampler.take_evicted())
+
+        if self.fsync == 'end':
+            while self.committed:
+                sync_tree(self.committed.popleft())
+
+        return list(self.failed)
+
+    def cancel(self):
+        """
+        Stops the run early. Repositories still to come are skipped as
+        soon as they're fetched. See Target.
+        """
+        if not self.cancelled.is_set():
+            logger.info('Target reached; cancelling the rest of the run')
+        self.cancelled.set()
+
+    def fetch(self, repo):
+        if self.cancelled.is_set():
+            self.stats.add('cancelled')
+            return
+        target_dir = os.path.join(self.directory, repo.owner, repo.name)
+        staging_dir = mkdirp(self.directory, STAGING_DIR)
+
+        # Archives are streamed to disk, a chunk at a time.
+        self.reserve(CHUNK_SIZE)
+        try:
+            snapshot = self.backend.fetch(repo, staging_dir)
+        except Exception:
+            logger.exception('Could not fetch %s', repo)
+            snapshot = None
+        finally:
+            self.release(CHUNK_SIZE)
+
+        if self.cancelled.is_set():
+            if snapshot:
+                snapshot.remove()
+            self.stats.add('cancelled')
+            return
+        if not snapshot:
+            logger.error('Could not download archive for %s', repo)
+            self.failed.append(repo)
+            return
+
+        self.stats.add('repositories')
+        yield Extraction(repo, snapshot, target_dir)
+
+    def extract(self, extraction):
+        if self.cancelled.is_set():
+            extraction.snapshot.remove()
+            self.stats.add('cancelled')
+            return
+        try:
+            jobs = self.plan_batches(extraction)
+        except Exception:
+            logger.exception('Could not extract %s', extraction.repo)
+            extraction.broken = True
+            jobs = [[]]
+        if not jobs:
+            return
+
+        extraction.pending = len(jobs)
+        for batch in jobs:
+            if not self.validates_in_chunks:
+                self.reserve(sum(self.footprint(extraction, filename)
+                                 for filename in batch))
+            yield extraction, batch
+
+    @property
+    def validates_in_chunks(self):
+        """
+        True if each repository's files are validated a few at a time, and
+        only reserved from the memory budget as they are; see validate().
+        """
+        return bool(self.sampler and self.sampler.per_repo)
+
+    def plan_batches(self, extraction):
+        """
+        Lists the repository's files that need validating, in batches.
+        Returns no batches at all if the repository is a mirror.
+        """
+        import tempfile
+        members = extraction.snapshot.members()
+        original = self.find_mirrored(extraction) if members else None
+        if original is not None:
+            logger.info('Skipping %s, a mirror of %s', extraction.repo,
+                        original)
+            self.stats.add('mirrors')
+            extraction.snapshot.remove()
+            if self.manifest:
+                self.manifest.write(extraction.repo, {}, mirror_of=original)
+            return []
+
+        if self.sampler:
+            members = self.sample(extraction.repo, members)
+        extraction.members = members
+        extraction.base_dir = tempfile.mkdtemp(
+            prefix='{0}-{1}-'.format(extraction.repo.owner,
+                                     extraction.repo.name),
+            dir=os.path.join(self.directory, STAGING_DIR))
+        names = self.changed_files(extraction)
+
+        # Always have at least one batch, so that the snapshot gets cleaned
+        # up even if it's empty.
+        if self.validates_in_chunks:
+            # Validated a few at a time, until there are enough; see
+            # validate().
+            jobs = [names]
+        else:
+            jobs = list(batches(names, max_bytes=self.spill_size,
+                                sizeof=functools.partial(self.footprint,
+                                                         extraction)))
+        return jobs or [[]]
+
+    def validate(self, item):
+        extraction, candidates = item
+        options = {'metrics': self.metrics, 'language': self.language,
+                   'minhash': self.near_duplicates is not None,
+                   'fork': self.pool is not None}
+        if self.spill_size:
+            options['spill_size'] = self.spill_size
+            options['spill_dir'] = os.path.join(self.directory, STAGING_DIR)
+
+        # With a cap on files per repository, candidates are validated in
+        # the order of their sampling keys, only as many at a time as are
+        # still needed, so the rest are never inflated, nor reserved.
+        wanted = len(candidates)
+        if self.validates_in_chunks:
+            wanted = self.sampler.per_repo - len(extraction.files)
+
+        batch, accepted = [], []
+        try:
+            while (candidates and len(accepted) < wanted and
+                   not self.cancelled.is_set()):
+                if self.sampler:
+                    # The sample may well have filled up since the batch
+                    # was made.
+                    candidates = self.still_wanted(extraction, candidates)
+                chunk = candidates[:wanted - len(accepted)]
+                candidates = candidates[len(chunk):]
+                if self.validates_in_chunks:
+                    self.reserve(sum(self.footprint(extraction, filename)
+                                     for filename in chunk))
+                batch.extend(chunk)
+                job = (extraction.snapshot, chunk, options)
+                if self.pool:
+                    passed, rejected = self.pool.apply(validate_batch, (job,))
+                else:
+                    passed, rejected = validate_batch(job)
+                accepted.extend(passed)
+                for reason, amount in rejected.items():
+                    self.stats.reject(reason, amount)
+        except Exception:
+            # The whole repository fails; writing the batch (of nothing)
+            # is what cleans it up.
+            logger.exception('Could not validate %s', extraction.repo)
+            extraction.broken = True
+            for _filename, content, _info in accepted:
+                if isinstance(content, SpilledFile):
+                    content.remove()
+            accepted = []
+
+        if not self.cancelled.is_set() and not extraction.broken:
+            self.stats.reject('sampled-out', len(candidates))
+        if not self.validates_in_chunks:
+            self.release(sum(self.footprint(extraction, filename)
+                             for filename in candidates))
+        yield extraction, batch, accepted
+
+    def write(self, item):
+        extraction, batch, accepted = item
+        try:
+            left_out = set(batch)
+            for filename, content, info in accepted:
+                # Nothing of a cancelled run's last repositories, or of a
+                # repository that failed, is kept.
+                if (self.cancelled.is_set() or extraction.broken or
+                        not self.keep_near_duplicate(extraction, filename,
+                                                     info)):
+                    if isinstance(content, SpilledFile):
+                        content.remove()
+                    continue
+                if self.sampler and not self.sampler.add(
+                        extraction.repo, relative_path(filename)):
+                    if isinstance(content, SpilledFile):
+                        content.remove()
+                    left_out.discard(filename)
+                    self.stats.reject('sampled-out')
+                    self.forget_near_duplicate(extraction.repo,
+                                               relative_path(filename))
+                    continue
+                info.update(extraction.members[filename])
+                path = filename
+                if self.compressor:
+                    if isinstance(content, SpilledFile):
+                        spilled, content = content, content.read()
+                        spilled.remove()
+                    content = self.compressor.compress(content)
+                    path += self.compressor.suffix
+                path = write_file(extraction.base_dir, path, content)
+                extraction.files[path] = info
+                left_out.discard(filename)
+                self.stats.add('files')
+                live_metrics.add('ghdwn_written_bytes_total', info['size'])
+            for filename in left_out:
+                extraction.rejected[relative_path(filename)] = \
+                    extraction.members[filename]
+        except Exception:
+            extraction.broken = True
+            for _filename, content, _info in accepted:
+                if isinstance(content, SpilledFile):
+                    content.remove()
+            raise
+        finally:
+            self.release(sum(self.footprint(extraction, filename)
+                             for filename in batch))
+            if extraction.batch_done():
+                self.finish(extraction)
+
+    def changed_files(self, extraction):
+        """
+        Returns the names of the files that changed since the previous run.
+        The rest are carried over from the previous run's manifest.
+        """
+        record = self.previous.get(extraction.repo.key)
+        if record is None:
+            return list(extraction.members)
+
+        files = record['files']
+        rejected = record.get('rejected', {})
+        suffix = self.compressor.suffix if self.compressor else ''
+        changed = []
+        for filename, checksum in extraction.members.items():
+            path = relative_path(filename)
+            info = files.get(path + suffix)
+            if (info is not None and same_checksum(info, checksum) and
+                    (not self.metrics or 'bytes' in info) and
+                    os.path.isfile(os.path.join(extraction.target_dir,
+                                                path + suffix))):
+                if self.sampler and not self.sampler.add(extraction.repo,
+                                                         path):
+                    self.stats.reject('sampled-out')
+                    continue
+                extraction.files[path + suffix] = info
+                extraction.carried.add(path + suffix)
+                self.stats.add('files')
+                self.stats.add('unchanged')
+            elif same_checksum(rejected.get(path), checksum):
+                extraction.rejected[path] = checksum
+                self.stats.add('unchanged')
+            else:
+                changed.append(filename)
+        return changed
+
+    def sample(self, repo, members):
+        """
+        Returns just the members that could make it into the sample, in the
+        order of their sampling keys, so that batches that come later are
+        the ones likeliest to be skipped.
+        """
+        keys = dict((filename, self.sampler.key(repo, relative_path(filename)))
+                    for filename in members
+                    if self.sampler.wanted(repo, relative_path(filename)))
+        self.stats.reject('sampled-out', len(members) - len(keys))
+        return collections.OrderedDict(
+            (filename, members[filename])
+            for filename in sorted(keys, key=keys.get))
+
+    def evict(self, evicted):
+        """
+        Deletes files that were pushed out of the sample after they were
+        written, and records what's left of their repositories. Files that
+        were tagged as near duplicates of them are no longer tagged.
+        """
+        if not evicted:
+            return
+        records = {}
+        if self.manifest:
+            records = load_manifest(self.manifest.path)
+        by_repo = collections.defaultdict(set)
+        for repo, path in evicted:
+            by_repo[repo].add(path)
+            self.forget_near_duplicate(repo, path)
+        self.stats.reject('sampled-out', len(evicted))
+
+        suffix = self.compressor.suffix if self.compressor else ''
+        for repo, paths in by_repo.items():
+            owner, name = repo.split('/', 1)
+            for path in paths:
+                filename = os.path.join(self.directory, owner, name,
+                                        *(path + suffix).split('/'))
+                if os.path.isfile(filename):
+                    os.remove(filename)
+                    self.stats.add('files', -1)
+
+        gone = set('{0}/{1}'.format(repo, path) for repo, path in evicted)
+        for key, record in records.items():
+            paths = by_repo.get('/'.join(key), ())
+            files = dict((path, info) for path, info in record['files'].items()
+                         if path[:len(path) - len(suffix)] not in paths)
+            for path, info in files.items():
+                if info.get('near_duplicate_of') in gone:
+                    files[path] = dict(info)
+                    del files[path]['near_duplicate_of']
+            if files != record['files']:
+                self.manifest.write(
+                    RepositoryInfo.from_dict(record['repository']), files,
+                    rejected=record.get('rejected'))
+
+    def still_wanted(self, extraction, candidates):
+        """
+        Returns the candidates that could still make it into the sample,
+        and lets go of the rest.
+        """
+        wanted = [filename for filename in candidates
+                  if self.sampler.wanted(extraction.repo,
+                                         relative_path(filename))]
+        self.stats.reject('sampled-out', len(candidates) - len(wanted))
+        if not self.validates_in_chunks:
+            self.release(sum(self.footprint(extraction, filename)
+                             for filename in set(candidates) - set(wanted)))
+        return wanted
+
+    def footprint(self, extraction, filename):
+        """
+        Returns how much of the memory budget a file takes up on its way
+        through the pipeline.
+        """
+        size = extraction.members[filename]['size']
+        return min(size, self.spill_size) if self.spill_size else size
+
+    def reserve(self, amount):
+        if self.budget:
+            self.budget.reserve(amount)
+
+    def release(self, amount):
+        if self.budget:
+            self.budget.release(amount)
+
+    def find_mirrored(self, extraction):
+        """
+        Returns the name of the repository this one is a mirror of, or None
+        if it's the first of its kind.
+        """
+        fingerprint = extraction.snapshot.fingerprint()
+        with self.lock:
+            original = self.fingerprints.setdefault(fingerprint,
+                                                    str(extraction.repo))
+        return original if original != str(extraction.repo) else None
+
+    def keep_near_duplicate(self, extraction, filename, info):
+        """
+        Returns False if the file should be dropped for nearly duplicating
+        a file already in the corpus.
+        """
+        signature = info.pop('minhash', None)
+        if self.near_duplicates is None or signature is None:
+            return True
+
+        key = '{0}/{1}'.format(extraction.repo, relative_path(filename))
+        original = self.near_duplicates.add(key, signature)
+        if original is None:
+            extraction.indexed.append(key)
+            return True
+        if self.near_dedup == 'drop':
+            self.stats.reject('near-duplicate')
+            return False
+        info['near_duplicate_of'] = original
+        return True
+
+    def forget_near_duplicate(self, repo, path):
+        """
+        Takes a file that won't be in the corpus after all out of the
+        near-duplicate index, so nothing else is dropped or tagged for
+        duplicating it.
+        """
+        if self.near_duplicates is not None:
+            self.near_duplicates.remove('{0}/{1}'.format(repo, path))
+
+    def finish(self, extraction):
+        import shutil
+        extraction.snapshot.remove()
+        # Extraction might have failed before there was a directory.
+        if extraction.base_dir and (self.cancelled.is_set() or
+                                    extraction.broken):
+            shutil.rmtree(extraction.base_dir)
+        if self.cancelled.is_set() or extraction.broken:
+            self.forget(extraction)
+        if self.cancelled.is_set():
+            self.stats.add('cancelled')
+            return
+        if extraction.broken:
+            logger.error('Could not download all of %s', extraction.repo)
+            self.failed.append(extraction.repo)
+            return
+
+        try:
+            self.commit(extraction)
+        except Exception:
+            logger.exception('Could not commit %s', extraction.repo)
+            shutil.rmtree(extraction.base_dir, ignore_errors=True)
+            self.forget(extraction)
+            self.failed.append(extraction.repo)
+            return
+        if self.near_duplicates is not None:
+            # Originals might have left the sample in the meantime.
+            for path, info in extraction.files.items():
+                original = info.get('near_duplicate_of')
+                if (path not in extraction.carried and original is not None
+                        and original not in self.near_duplicates):
+                    del info['near_duplicate_of']
+        if self.manifest:
+            self.manifest.write(extraction.repo, extraction.files,
+                                rejected=extraction.rejected)
+        if self.target:
+            self.target.add(len(extraction.files),
+                            sum(info.get('size', 0)
+                                for info in extraction.files.values()))
+            if self.target.reached():
+                self.cancel()
+
+    def forget(self, extraction):
+        """
+        Takes back everything a repository that won't be committed added
+        along the way, so that it doesn't count against retrying it.
+        """
+        if self.sampler:
+            self.sampler.discard(extraction.repo)
+        if self.near_duplicates is not None:
+            for key in extraction.indexed:
+                self.near_duplicates.remove(key)
+
+    def commit(self, extraction):
+        """
+        Links the files carried over from the previous run into the
+        repository's new directory, then puts it in place of the old one.
+        Files that are gone, or are no longer good enough, go with the old
+        directory. Until then, the old directory is left just as it was.
+        """
+        import shutil
+        target_dir, base_dir = extraction.target_dir, extraction.base_dir
+        # Nothing outside of the corpus is ever replaced.
+        inside = os.path.relpath(target_dir, self.directory).split(os.sep)
+        assert len(inside) == 2 and os.pardir not in inside, target_dir
+        for path in extraction.carried:
+            parts = path.split('/')
+            mkdirp(base_dir, *parts[:-1])
+            source = os.path.join(target_dir, *parts)
+            try:
+                os.link(source, os.path.join(base_dir, *parts))
+            except (AttributeError, OSError):
+                # No hard links here; copying is slower, but just as safe.
+                shutil.copy2(source, os.path.join(base_dir, *parts))
+
+        if self.fsync == 'repo':
+            sync_tree(base_dir)
+
+        if os.path.exists(target_dir):
+            old_dir = base_dir + '.old'
+            os.rename(target_dir, old_dir)
+            os.rename(base_dir, target_dir)
+            shutil.rmtree(old_dir)
+        else:
+            mkdirp(os.path.dirname(target_dir))
+            os.rename(base_dir, target_dir)
+
+        if self.fsync == 'repo':
+            sync_path(os.path.dirname(target_dir))
+        elif self.fsync == 'end':
+            self.committed.append(target_dir)
+
+
+# How files in a corpus can be compressed.
+COMPRESSORS = {'gzip': GzipCompressor, 'zstd': ZstdCompressor}
+
+
+def download_repo(repo, directory, language="python", retry=None, pool=None):
+    """
+    Downloads a repository and keeps only the files that validly compile.
+    Returns False if the repository could not be downloaded.
+
+    If given a multiprocessing pool, the archive's members are inflated and
+    validated in batches across its processes, while this process writes
+    the files that pass.
+    """
+    builder = CorpusBuilder(directory, language, retry, pool)
+    return not builder.run([repo])
+
+
+def download_corpus(language, directory, quantity=1024, retry=None,
+                    index_format='json', **options):
+    """
+    Searches for the most popular repositories in the language and
+    downloads them as a corpus to the given directory. Returns the list of
+    repositories that could not be downloaded, even after retrying them at
+    the end of the run.
+
+    The index of repositories is written to the directory in the given
+    format (see IndexWriter). Everything else is passed on to
+    download_index().
+    """
+    retry = retry or RetryPolicy()
+    index = search_index(language, directory, quantity, retry, index_format)
+    return download_index(index, directory, language, retry, **options)
+
+
+def search_index(language, directory, quantity=1024, retry=None,
+                 index_format='json'):
+    """
+    Searches for the most popular repositories in the language, and writes
+    them to an index in the directory, in the given format (see
+    IndexWriter). Returns the repositories found.
+    """
     # Create the directory if it doesn't exist first!
     if not os.path.exists(directory):
         os.mkdir(directory)
 
     j = lambda *args: os.path.join(directory, *args)
 
-    index = get_github_list(language, quantity)
+    # Persist the index to a file as the search results come in. Results
+    # can shift between pages while we're searching, so skip any repeats.
+    index, seen = [], set()
+    search = GitHubSearchRequester(language, retry)
+    with IndexWriter(j(INDEX_FORMATS[index_format]), index_format) as f:
+        for repo in itertools.islice(search, quantity):
+            if repo.key in seen:
+                continue
+            seen.add(repo.key)
+            index.append(repo)
+            f.write(repo)
     logger.info('Found %d/%d results for %s', len(index), quantity, language)
+    return index
+
+
+def download_index(index, directory, language='python', retry=None,
+                   processes=None, workers=None, queue_size=QUEUE_SIZE,
+                   order=None, max_repo_size=None, max_total_size=None,
+                   partition=None, backend='zip', file_stats=False,
+                   near_dedup=None, near_dedup_threshold=0.8,
+                   skip_forks=False, compression=None, fsync='none',
+                   max_memory=None, sample=None, sample_per_repo=None,
+                   seed=0, target_files=None, target_size=None,
+                   time_limit=None):
+    """
+    Downloads the repositories in the index (a list of RepositoryInfos, or
+    the path to an index file) to the given directory, without searching
+    GitHub. Returns the list of repositories that could not be downloaded,
+    even after retrying them at the end of the run. What was written is
+    recorded in the directory's manifest.
+
+    Given a (number, partitions) tuple as the `partition`, only that
+    partition of the index is downloaded, and recorded in a manifest of its
+    own; see coordinate() and merge_manifests(). None of the
+    RUN_WIDE_OPTIONS can be given along with a partition.
+
+    Archives are extracted using the given number of processes (by default,
+    one per CPU). See CorpusBuilder for `workers` and `queue_size`, and
+    plan_downloads() for `order`, `max_repo_size` and `max_total_size`.
+
+    `backend` is the name of one of the BACKENDS, or a backend.
+
+    With `file_stats`, every file is measured as it's validated, and the
+    measurements are written to the directory's FILE_STATS_NAME (see
+    write_file_stats).
+
+    With `near_dedup` set to one of the NEAR_DEDUP_ACTIONS, 'drop' or
+    'tag', files that are at least `near_dedup_threshold` similar to a file
+    already downloaded are dropped or tagged in the manifest; see
+    NearDuplicateIndex. When partitioned, only files within the same
+    partition are compared.
+
+    With `skip_forks`, repositories the index says are forks are not
+    downloaded at all.
+
+    Downloading to a directory that already has a manifest refreshes it:
+    only files that changed since are extracted again.
+
+    `compression` is the name of one of the COMPRESSORS to write files
+    with; read them back with CorpusReader. `fsync` is one of the
+    FSYNC_POLICIES.
+
+    `max_memory` roughly limits how many bytes of files are held in memory
+    at once; see MemoryBudget.
+
+    Given `sample` and/or `sample_per_repo`, only a random sample of that
+    many files overall and/or from each repository is kept, chosen the same
+    way every time for the same `seed`; see Sampler.
+
+    The run stops early, as soon as `target_files` files or `target_size`
+    bytes of files are in the corpus, or `time_limit` seconds have gone by;
+    see Target. Pair with `order='most-stars'` to get the best repositories
+    that fit.
+    """
+    import multiprocessing
+    if partition is not None:
+        check_partitionable(dict(sample=sample, target_files=target_files,
+                                 target_size=target_size))
+    if isinstance(index, str):
+        index = load_index(index)
+    retry = retry or RetryPolicy()
+    if backend == 'zip':
+        backend = ZipBackend(retry)
+    elif backend in BACKENDS:
+        backend = BACKENDS[backend](retry=retry)
+    elif isinstance(backend, str):
+        raise ValueError('Unknown backend: %r' % (backend,))
+    if fsync not in FSYNC_POLICIES:
+        raise ValueError('Unknown fsync policy: %r' % (fsync,))
+    if near_dedup is not None and near_dedup not in NEAR_DEDUP_ACTIONS:
+        raise ValueError('Unknown near-duplicate action: %r' % (near_dedup,))
+    processes = processes or multiprocessing.cpu_count()
 
-    # Persist the index to a file.
-    with open(j('index.json'), 'w') as f:
-        json.dump([repo.as_dict() for repo in index], f)
+    if not os.path.exists(directory):
+        os.mkdir(directory)
+    compressor = None
+    if compression:
+        compressor = COMPRESSORS[compression](directory, language)
+
+    manifest_name = MANIFEST_NAME
+    if partition is not None:
+        number, partitions = partition
+        index = [repo for repo in index
+                 if partition_of(repo, partitions) == number]
+        manifest_name = MANIFEST_PART_NAME.format(number, partitions)
+
+    workers = dict({'validate': processes}, **(workers or {}))
+    planned, skipped = plan_downloads(index, order,
+                                      workers.get('fetch') or
+                                      DEFAULT_WORKERS['fetch'],
+                                      max_repo_size, max_total_size,
+                                      skip_forks)
+    if skipped:
+        logger.info('Skipping %d repositories: %s',
+                    len(skipped), ', '.join(str(repo) for repo in skipped))
+
+    pool = multiprocessing.Pool(processes) if processes > 1 else None
+    previous = load_manifest(os.path.join(directory, manifest_name))
+    manifest = Manifest(os.path.join(directory, manifest_name))
+    near_duplicates = None
+    if near_dedup:
+        near_duplicates = NearDuplicateIndex(near_dedup_threshold)
+    sampler = None
+    if sample or sample_per_repo:
+        sampler = Sampler(sample, sample_per_repo, seed)
+    target = None
+    if (target_files, target_size, time_limit) != (None, None, None):
+        target = Target(target_files, target_size, time_limit)
+    builder = CorpusBuilder(directory, language, retry, pool, workers,
+                            queue_size, manifest, backend, file_stats,
+                            near_duplicates, near_dedup, previous,
+                            compressor, fsync,
+                            MemoryBudget(max_memory) if max_memory else None,
+                            sampler, target)
+    try:
+        failed = builder.run(planned)
+        # Give the repositories that failed one last shot, once everything
+        # else is done and whatever was wrong has hopefully cleared up.
+        if failed and not builder.cancelled.is_set():
+            failed = builder.run(failed)
+    finally:
+        manifest.close()
+        if pool:
+            pool.close()
+            pool.join()
+
+    if file_stats:
+        write_file_stats(load_manifest(manifest.path), os.path.join(
+            directory, stats_name_for(manifest_name)))
+
+    cancelled = builder.stats.counts['cancelled']
+    logger.info('Downloaded %d/%d repositories (%d failed, %d cancelled)',
+                len(planned) - len(failed) - cancelled, len(planned),
+                len(failed), cancelled)
+    logger.info('Corpus stats: %s', builder.stats)
+    return failed
+
+
+def write_file_stats(records, path):
+    """
+    Writes the per-file measurements in the manifest records to a columnar
+    JSON file: an object with a list for each of the FILE_STATS_COLUMNS,
+    and for the path of each file, that are all in the same order.
+    Files that were never measured are left out.
+    """
+    columns = dict((name, []) for name in ('path',) + FILE_STATS_COLUMNS)
+    for record in records.values():
+        repo = RepositoryInfo.from_dict(record['repository'])
+        for name, info in sorted(record['files'].items()):
+            if 'bytes' not in info:
+                continue
+            columns['path'].append('{0}/{1}'.format(repo, name))
+            for column in FILE_STATS_COLUMNS:
+                columns[column].append(info[column])
+
+    with open(path, 'w') as f:
+        json.dump(columns, f, sort_keys=True)
+    return len(columns['path'])
+
+
+def stats_name_for(manifest_name):
+    """
+    >>> stats_name_for('manifest-1-of-4.jsonl')
+    'file_stats-1-of-4.json'
+    """
+    return manifest_name.replace('manifest', 'file_stats').replace(
+        '.jsonl', '.json')
+
+
+def partition_of(repo, partitions):
+    """
+    Returns which partition the repository belongs to. Unlike hash(), this
+    is the same in every process, on every machine.
+
+    >>> partition_of(RepositoryInfo('eddieantonio', 'dev'), 4)
+    2
+    """
+    import hashlib
+    digest = hashlib.md5(str(repo).encode('utf-8')).hexdigest()
+    return int(digest[:8], 16) % partitions
+
+
+def load_manifest(path):
+    """
+    Returns the manifest's records, keyed by (owner, name). Later records
+    for the same repository replace earlier ones.
+    """
+    records = collections.OrderedDict()
+    if not os.path.exists(path):
+        return records
+    with open(path) as f:
+        for line in f:
+            if not line.endswith('\n'):
+                # Still being written.
+                break
+            record = json.loads(line)
+            repo = RepositoryInfo.from_dict(record['repository'])
+            records[repo.key] = record
+    return records
+
+
+def merge_manifests(directory):
+    """
+    Combines the manifests written by each worker of a partitioned download
+    into the directory's one and only manifest. Returns how many
+    repositories it lists.
+    """
+    import glob
+    records = load_manifest(os.path.join(directory, MANIFEST_NAME))
+    pattern = MANIFEST_PART_NAME.replace('{0:d}', '*').replace('{1:d}', '*')
+    for path in sorted(glob.glob(os.path.join(directory, pattern))):
+        records.update(load_manifest(path))
+
+    merged_path = os.path.join(directory, MANIFEST_NAME)
+    with open(merged_path + '.tmp', 'w') as f:
+        for key in sorted(records):
+            f.write(json.dumps(records[key], sort_keys=True) + '\n')
+    os.rename(merged_path + '.tmp', merged_path)
+
+    # Bring together the workers' file statistics too, if they kept any.
+    if glob.glob(os.path.join(directory, stats_name_for(pattern))):
+        write_file_stats(records, os.path.join(directory, FILE_STATS_NAME))
+
+    return len(records)
+
+
+class CorpusReader(object):
+
+    """
+    Reads the files of a corpus, as listed in its manifest, decompressing
+    them if they were written compressed.
+
+    Iterating yields (repository, path, content) for every file, where
+    the path is within the repository's directory, as it was in the
+    repository.
+    """
+
+    def __init__(self, directory):
+        import glob
+        self.directory = directory
+        self.dictionaries = {}
+        pattern = os.path.join(directory, DICTIONARY_NAME.format('*', '*'))
+        for path in glob.glob(pattern):
+            with open(path, 'rb') as f:
+                dictionary = zstd().ZstdCompressionDict(f.read())
+            self.dictionaries[dictionary.dict_id()] = dictionary
+
+    def __iter__(self):
+        records = load_manifest(os.path.join(self.directory, MANIFEST_NAME))
+        for record in records.values():
+            repo = RepositoryInfo.from_dict(record['repository'])
+            for path in sorted(record['files']):
+                content = self.read(os.path.join(
+                    self.directory, repo.owner, repo.name, path))
+                yield repo, split_compressed(path)[0], content
+
+    def read(self, path):
+        """
+        Returns the contents of the file at the given path, decompressed.
+        """
+        with open(path, 'rb') as f:
+            content = f.read()
+        return decompress(content, split_compressed(path)[1],
+                          self.dictionaries)
+
+
+def split_compressed(path):
+    """
+    Splits the suffix of any of the COMPRESSORS from a path.
+
+    >>> split_compressed('ghdwn.py.gz')
+    ('ghdwn.py', '.gz')
+    >>> split_compressed('ghdwn.py')
+    ('ghdwn.py', '')
+    """
+    for compressor in COMPRESSORS.values():
+        if path.endswith(compressor.suffix):
+            return path[:-len(compressor.suffix)], compressor.suffix
+    return path, ''
+
+
+def coordinate(index_path, directory, partitions, options=None):
+    """
+    Downloads the index with the given number of local worker processes,
+    each working on its own partition of the index, then merges their
+    manifests. Returns the number of workers that failed. The workers are
+    given the same download options, from pop_download_options().
+
+    The RUN_WIDE_OPTIONS can't be split between workers, and are refused.
+    `max_memory` is the budget for all of the workers together, so each
+    gets its share.
+
+    Since every repository gets its own directory, workers on different
+    machines can share the output directory just as well; run
+    `ghdwn fetch FILE DIRECTORY --partition N/PARTITIONS` on each, and
+    `ghdwn merge DIRECTORY` once they're all done.
+    """
+    import subprocess
+    options = dict(options or {})
+    check_partitionable(options)
+    if options.get('max_memory'):
+        options['max_memory'] = max(1, options['max_memory'] // partitions)
+    if not os.path.exists(directory):
+        os.mkdir(directory)
+
+    env = dict(os.environ)
+    module_dir = os.path.dirname(os.path.abspath(__file__))
+    env['PYTHONPATH'] = os.pathsep.join(
+        filter(None, [module_dir, env.get('PYTHONPATH')]))
+
+    # Workers record or replay traffic the same way this process does.
+    transport_options = []
+    if transport is not None:
+        transport_options = ['--' + transport.mode, transport.store.directory]
+
+    def metrics_options(n):
+        # Each worker serves its metrics on the next port along.
+        if live_metrics.server is None:
+            return []
+        host, port = live_metrics.server.server_address[:2]
+        return ['--metrics', '{0}:{1:d}'.format(host, port + 1 + n)]
+
+    download_options = []
+    for option, name, _ in DOWNLOAD_OPTIONS:
+        if name in options:
+            download_options += [option, str(options[name])]
+
+    workers = [subprocess.Popen([sys.executable, '-m', 'ghdwn',
+                                 'fetch', index_path, directory,
+                                 '--partition',
+                                 '{0:d}/{1:d}'.format(n, partitions)] +
+                                download_options + transport_options +
+                                metrics_options(n),
+                                env=env)
+               for n in range(partitions)]
+    failures = sum(1 for worker in workers if worker.wait() != 0)
+
+    logger.info('Merged manifests of %d repositories',
+                merge_manifests(directory))
+    return failures
+
+
+def check_partitionable(options):
+    """
+    Raises ValueError if any of the RUN_WIDE_OPTIONS are set.
+
+    >>> check_partitionable({'sample': None, 'seed': 4})
+    >>> check_partitionable({'target_files': 100})
+    Traceback (most recent call last):
+      ...
+    ValueError: target_files limits the whole run, so it can't be partitioned
+    """
+    for name in RUN_WIDE_OPTIONS:
+        if options.get(name) is not None:
+            raise ValueError("{0} limits the whole run, so it can't be "
+                             "partitioned".format(name))
+
+
+def pop_option(argv, name):
+    """
+    Removes the option and its value from the argument list, returning the
+    value, or None if the option is not there.
+
+    >>> argv = ['ghdwn', 'fetch', 'index.json', '--partition', '1/4']
+    >>> pop_option(argv, '--partition'), argv
+    ('1/4', ['ghdwn', 'fetch', 'index.json'])
+    """
+    if name not in argv:
+        return None
+    position = argv.index(name)
+    value = argv[position + 1] if position + 1 < len(argv) else None
+    del argv[position:position + 2]
+    return value
+
+
+def corpus_status(directory):
+    """
+    Says how far along the download of a corpus is, from its index and
+    manifests alone. A corpus that isn't there yet has nothing so far.
+    """
+    import fnmatch
+    records = load_manifest(os.path.join(directory, MANIFEST_NAME))
+    pattern = MANIFEST_PART_NAME.replace('{0:d}', '*').replace('{1:d}', '*')
+    names = os.listdir(directory) if os.path.isdir(directory) else []
+    for name in sorted(fnmatch.filter(names, pattern)):
+        records.update(load_manifest(os.path.join(directory, name)))
+
+    index = []
+    for name in INDEX_FORMATS.values():
+        if os.path.exists(os.path.join(directory, name)):
+            index = load_index(os.path.join(directory, name))
+            break
+
+    return collections.OrderedDict([
+        ('indexed', len(index)),
+        ('downloaded', len(records)),
+        ('mirrors', sum(1 for record in records.values()
+                        if 'mirror_of' in record)),
+        ('remaining', sum(1 for repo in index if repo.key not in records)),
+        ('files', sum(len(record['files']) for record in records.values())),
+    ])
+
+
+def corpus_file_stats(directory):
+    """
+    Totals up the sizes of a corpus's files: the columns of its
+    FILE_STATS_NAME if it has one, or else just their sizes from its
+    manifest.
+    """
+    path = os.path.join(directory, FILE_STATS_NAME)
+    if os.path.exists(path):
+        with open(path) as f:
+            columns = json.load(f)
+        totals = [('files', len(columns['path']))]
+        totals += [(column, sum(columns[column]))
+                   for column in FILE_STATS_COLUMNS]
+        return collections.OrderedDict(totals)
+
+    records = load_manifest(os.path.join(directory, MANIFEST_NAME))
+    sizes = [info.get('size', 0) for record in records.values()
+             for info in record['files'].values()]
+    return collections.OrderedDict([('files', len(sizes)),
+                                    ('bytes', sum(sizes))])
+
+
+# The command-line options for download_index(): each option, the keyword
+# argument it's for, and how to parse its value.
+DOWNLOAD_OPTIONS = (
+    ('--order', 'order', str),
+    ('--backend', 'backend', str),
+    ('--compress', 'compression', str),
+    ('--fsync', 'fsync', str),
+    ('--max-memory', 'max_memory', parse_size),
+    ('--sample', 'sample', int),
+    ('--sample-per-repo', 'sample_per_repo', int),
+    ('--seed', 'seed', int),
+    ('--target-files', 'target_files', int),
+    ('--target-size', 'target_size', parse_size),
+    ('--time-limit', 'time_limit', parse_duration),
+)
+
+
+def pop_download_options(argv):
+    """
+    Removes the options for download_index() from the argument list, and
+    returns them as keyword arguments.
+
+    >>> argv = ['fetch', 'index.json', '--compress', 'gzip', '--seed', '4']
+    >>> sorted(pop_download_options(argv).items()), argv
+    ([('compression', 'gzip'), ('seed', 4)], ['fetch', 'index.json'])
+    """
+    options = {}
+    for option, name, parse in DOWNLOAD_OPTIONS:
+        value = pop_option(argv, option)
+        if value:
+            options[name] = parse(value)
+    return options
 
-    for repo in index:
-        download_repo(repo, directory, language)
+
+def search_command(argv):
+    """
+    search LANGUAGE [DIRECTORY [QUANTITY]] [--format json|jsonl]
+
+    Writes an index of the most popular repositories in the language,
+    without downloading them.
+    """
+    index_format = pop_option(argv, '--format') or 'json'
+    if not argv:
+        return usage()
+    directory = argv[1] if len(argv) >= 2 else './corpus'
+    quantity = int(argv[2]) if len(argv) >= 3 else 1024
+    search_index(argv[0], directory, quantity, index_format=index_format)
+    return 0
+
+
+def fetch_command(argv):
+    """
+    fetch INDEX [DIRECTORY] [--partition N/TOTAL | --coordinate WORKERS]
+          [--backend zip|git] [--compress gzip|zstd] [--fsync none|repo|end]
+          [--max-memory SIZE] [--sample FILES] [--sample-per-repo FILES]
+          [--seed N] [--order most-stars|largest-first|bin-pack]
+          [--target-files FILES] [--target-size SIZE] [--time-limit TIME]
+
+    Downloads the repositories in an index.
+    """
+    partition = pop_option(argv, '--partition')
+    coordinate_workers = pop_option(argv, '--coordinate')
+    options = pop_download_options(argv)
+    if not argv:
+        return usage()
+    directory = argv[1] if len(argv) >= 2 else './corpus'
+    if coordinate_workers:
+        return 1 if coordinate(argv[0], directory, int(coordinate_workers),
+                               options) else 0
+    if partition:
+        number, partitions = partition.split('/')
+        options['partition'] = int(number), int(partitions)
+    return 1 if download_index(argv[0], directory, **options) else 0
+
+
+def status_command(argv):
+    """
+    status [DIRECTORY]
+
+    Says how far along the download of a corpus is.
+    """
+    directory = argv[0] if argv else './corpus'
+    for name, value in corpus_status(directory).items():
+        print('{0}: {1:d}'.format(name, value))
+    return 0
+
+
+def stats_command(argv):
+    """
+    stats [DIRECTORY]
+
+    Totals up the sizes of a corpus's files.
+    """
+    directory = argv[0] if argv else './corpus'
+    for name, value in corpus_file_stats(directory).items():
+        print('{0}: {1:d}'.format(name, value))
+    return 0
+
+
+def merge_command(argv):
+    """
+    merge [DIRECTORY]
+
+    Merges the manifests of a partitioned download.
+    """
+    merge_manifests(argv[0] if argv else './corpus')
+    return 0
+
+
+# The subcommands of the command line, in the order they're listed.
+COMMANDS = collections.OrderedDict([
+    ('search', search_command),
+    ('fetch', fetch_command),
+    ('status', status_command),
+    ('stats', stats_command),
+    ('merge', merge_command),
+])
 
 
 def usage():
-    message = ("Usage:\n"
-               "\t{0} language [directory [quantity]]\n\n")
-    sys.stderr.write(message.format(sys.argv[0]))
+    message = ["Usage:\n"]
+    for command in COMMANDS.values():
+        synopsis = command.__doc__.strip().split('\n\n')[0].split('\n')
+        message.append('\t{0} ' + '\n\t\t'.join(
+            line.strip() for line in synopsis) + '\n')
+    message.append("\nOr, to search and download in one go:\n"
+                   "\t{0} LANGUAGE [DIRECTORY [QUANTITY]] [fetch options]\n"
+                   "\nAny command can record its HTTP traffic, or replay "
+                   "it without the network:\n"
+                   "\t--record DIRECTORY | --replay DIRECTORY\n"
+                   "\nOr serve live metrics over HTTP, at /metrics:\n"
+                   "\t--metrics [HOST:]PORT\n")
+    sys.stderr.write(''.join(message).format(
+        os.path.basename(sys.argv[0])))
+    return -1
 
 
 def main(argv=sys.argv):
+    logging.basicConfig()
+    argv = list(argv)
+    for mode in TRANSPORTS:
+        directory = pop_option(argv, '--' + mode)
+        if directory:
+            use_transport(mode, directory)
+    address = pop_option(argv, '--metrics')
+    if address:
+        serve_metrics(parse_address(address))
+
     if len(argv) <= 1:
-        usage()
-        exit(-1)
+        exit(usage())
+
+    if argv[1] in COMMANDS:
+        return COMMANDS[argv[1]](argv[2:])
+
+    # The way things were done before there were subcommands.
+    if argv[1] == '--merge':
+        return merge_command(argv[2:])
+    if argv[1] == '--index':
+        return fetch_command(argv[2:])
 
+    options = pop_download_options(argv)
     language = argv[1]
     directory = argv[2] if len(argv) >= 3 else './corpus'
     quantity = int(argv[3]) if len(argv) >= 4 else 1024
-    download_corpus(language, directory, quantity)
+    download_corpus(language, directory, quantity, **options)
 
 if __name__ == '__main__':
     exit(main())
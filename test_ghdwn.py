@@ -6,6 +6,12 @@ Tests GitHub downloading thingymobber.
 """
 
 import httpretty
+import json
+import multiprocessing
+import py
+import pytest
+import subprocess
+import zipfile
 from itertools import count
 
 import ghdwn
@@ -174,7 +180,7 @@ def test_download_corpus(monkeypatch, tmpdir):
                            status=404)
 
     # Download that entire corpus.
-    ghdwn.download_corpus('python', 'corpus')
+    failed = ghdwn.download_corpus('python', 'corpus')
 
     # Teardown httpretty.
     # Again, this function is not wrapped in @httpretty.activate,
@@ -184,6 +190,9 @@ def test_download_corpus(monkeypatch, tmpdir):
 
     corpus_dir = tmpdir.join('corpus')
 
+    # The 404 is reported, even after being retried at the end.
+    assert failed == [('django', 'reinhardt')]
+
     assert corpus_dir.check(dir=True)
 
     assert corpus_dir.join('index.json').check(file=True)
@@ -201,3 +210,1139 @@ def test_download_corpus(monkeypatch, tmpdir):
     # This file is nested, but it compiles just fine!
     assert corpus_dir.join('eddieantonio', repo, 'working',
                            '__init__.py').check(file=True)
+
+
+def test_download_retries(tmpdir):
+    httpretty.enable()
+    naps = []
+    retry = ghdwn.RetryPolicy(sleep=naps.append)
+    repo = ghdwn.RepositoryInfo('eddieantonio', 'dev')
+
+    # GitHub is having a bad day, but gets better.
+    httpretty.register_uri(httpretty.GET, repo.archive_url, responses=[
+        httpretty.Response(body='', status=503),
+        httpretty.Response(body='', status=502),
+        httpretty.Response(body=mock_data.dev_zip,
+                           content_type='application/zip'),
+    ])
+
+    archive = ghdwn.download_repo_zip(repo, retry, str(tmpdir))
+    assert archive is not None
+    assert 'dev-master/dev.py' in archive.namelist()
+    assert len(naps) == 2
+    assert retry.budget == 254
+
+    # A repository that doesn't exist is not retried at all.
+    missing = ghdwn.RepositoryInfo('django', 'reinhardt')
+    httpretty.register_uri(httpretty.GET, missing.archive_url, status=404)
+    assert ghdwn.download_repo_zip(missing, retry, str(tmpdir)) is None
+    assert len(naps) == 2
+
+    httpretty.disable()
+    httpretty.reset()
+
+
+def test_download_resumes(tmpdir):
+    httpretty.enable()
+    repo = ghdwn.RepositoryInfo('eddieantonio', 'dev')
+    ranges = []
+
+    def request_callback(request, uri, headers):
+        ranges.append(request.headers.get('Range'))
+        headers['Content-Range'] = 'bytes 1000-{0:d}/{1:d}'.format(
+            len(mock_data.dev_zip) - 1, len(mock_data.dev_zip))
+        return 206, headers, mock_data.dev_zip[1000:]
+
+    httpretty.register_uri(httpretty.GET, repo.archive_url,
+                           body=request_callback,
+                           content_type='application/zip')
+
+    # Pretend the connection dropped after the first 1000 bytes.
+    partial = tmpdir.join('eddieantonio-dev.zip.part')
+    partial.write(mock_data.dev_zip[:1000], mode='wb')
+
+    archive = ghdwn.download_repo_zip(repo, staging_dir=str(tmpdir))
+
+    httpretty.disable()
+    httpretty.reset()
+
+    assert ranges == ['bytes=1000-']
+    assert not partial.check()
+    assert tmpdir.join('eddieantonio-dev.zip').read(mode='rb') == \
+        mock_data.dev_zip
+    assert 'dev-master/dev.py' in archive.namelist()
+
+
+def test_download_repo_in_parallel(tmpdir):
+    httpretty.enable()
+    repo = ghdwn.RepositoryInfo('eddieantonio',
+                                'syntax-errors-up-the-ying-yang')
+    httpretty.register_uri(httpretty.GET, repo.archive_url,
+                           body=mock_data.broken_zip,
+                           content_type='application/zip')
+
+    pool = multiprocessing.Pool(2)
+    try:
+        assert ghdwn.download_repo(repo, str(tmpdir), pool=pool)
+    finally:
+        pool.close()
+        pool.join()
+        httpretty.disable()
+        httpretty.reset()
+
+    repo_dir = tmpdir.join('eddieantonio', repo.name)
+    assert repo_dir.join('working', '__init__.py').check(file=True)
+    assert len(repo_dir.listdir()) == 1
+    # The archive is cleaned up afterwards.
+    assert tmpdir.join(ghdwn.STAGING_DIR).listdir() == []
+
+
+def test_pipeline_survives_errors():
+    written = []
+
+    def fetch(n):
+        if n == 3:
+            raise IOError('Connection reset by peer')
+        yield n
+
+    pipeline = ghdwn.Pipeline(queue_size=1)
+    pipeline.add_stage('fetch', fetch, workers=3)
+    pipeline.add_stage('validate', lambda n: [n] if n % 2 else [], workers=2)
+    pipeline.add_stage('write', written.append)
+    pipeline.run(range(10))
+
+    assert sorted(written) == [1, 5, 7, 9]
+
+
+def test_broken_repositories_fail(tmpdir):
+    import io
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_STORED) as archive:
+        archive.writestr('corrupt-master/ok.py', b'x = 1\n')
+        archive.writestr('corrupt-master/bad.py', b'y = 2\n')
+    # Same length, different bytes: the CRC-32 no longer matches.
+    corrupt = buffer.getvalue().replace(b'y = 2', b'y = 3')
+
+    class Backend(LocalBackend):
+        def fetch(self, repo, staging_dir):
+            if repo.name == 'bogus':
+                raise AssertionError('Not a zip')
+            return LocalBackend.fetch(self, repo, staging_dir)
+
+    backend = Backend({
+        ('alice', 'corrupt'): corrupt,
+        ('alice', 'utils'): make_zip({'utils-master/utils.py': 'x = 1\n'}),
+    })
+    repos = [ghdwn.RepositoryInfo('alice', name)
+             for name in ('corrupt', 'bogus', 'utils')]
+    failed = ghdwn.download_index(repos, str(tmpdir), processes=1,
+                                  backend=backend)
+
+    assert sorted(failed) == [('alice', 'bogus'), ('alice', 'corrupt')]
+    assert list(ghdwn.load_manifest(str(tmpdir.join(
+        ghdwn.MANIFEST_NAME)))) == [('alice', 'utils')]
+    assert not tmpdir.join('alice', 'corrupt').check()
+    # Neither the archive nor its half-written files are left behind.
+    assert tmpdir.join(ghdwn.STAGING_DIR).listdir() == []
+
+
+def test_threads_never_fork(tmpdir, monkeypatch):
+    def fork():
+        raise AssertionError('Forked from a multi-threaded process')
+    monkeypatch.setattr(ghdwn.os, 'fork', fork)
+
+    backend = LocalBackend({
+        ('alice', 'utils'): make_zip({'utils-master/utils.py': 'x = 1\n',
+                                      'utils-master/bad.py': 'x = (\n'}),
+    })
+    failed = ghdwn.download_index([ghdwn.RepositoryInfo('alice', 'utils')],
+                                  str(tmpdir), processes=1, backend=backend)
+
+    assert failed == []
+    assert tmpdir.join('alice', 'utils', 'utils.py').check(file=True)
+    assert not tmpdir.join('alice', 'utils', 'bad.py').check()
+
+
+def test_validate_batch_prefilters(tmpdir):
+    archive_path = str(tmpdir.join('mixed-master.zip'))
+    with zipfile.ZipFile(archive_path, 'w') as archive:
+        archive.writestr('mixed-master/', b'')
+        archive.writestr('mixed-master/good.py', b'print("Hello, World!")\n')
+        archive.writestr('mixed-master/bad.py', b'import java.util.*;\n')
+        archive.writestr('mixed-master/logo.png', b'\x89PNG\r\n\x1a\n')
+        archive.writestr('mixed-master/data.bin', b'ABC\x00\x01\x02')
+        archive.writestr('mixed-master/__init__.py', b'')
+        names = archive.namelist()
+
+    snapshot = ghdwn.ZipSnapshot(archive_path)
+    accepted, rejected = ghdwn.validate_batch((snapshot, names))
+
+    assert accepted == [
+        ('mixed-master/good.py', b'print("Hello, World!")\n', {})]
+    assert rejected == {
+        'syntax': 1,
+        'magic:png': 1,
+        'nul-bytes': 1,
+        'empty': 1,
+    }
+
+
+def test_repository_info_is_a_value():
+    import pickle
+
+    repo = ghdwn.RepositoryInfo('eddieantonio', 'dev', 'master', stars=1)
+
+    # Equal in all the ways that count.
+    assert repo == ghdwn.RepositoryInfo('eddieantonio', 'dev')
+    assert repo == ('eddieantonio', 'dev')
+    assert repo != ghdwn.RepositoryInfo('eddieantonio', 'dev', 'gh-pages')
+    assert hash(repo) == hash(('eddieantonio', 'dev'))
+    assert pickle.loads(pickle.dumps(repo)).stars == 1
+
+    # Can't be changed behind a set's back...
+    try:
+        repo.name = 'perfection'
+    except AttributeError:
+        pass
+    else:
+        assert False, 'RepositoryInfo should be immutable'
+
+    # ...and takes no more room than it needs.
+    assert not hasattr(repo, '__dict__')
+
+
+def test_plan_downloads():
+    Repo = ghdwn.RepositoryInfo
+    index = [Repo('a', 'small', size=1), Repo('b', 'huge', size=100),
+             Repo('c', 'medium', size=10), Repo('d', 'unknown'),
+             Repo('e', 'big', size=50)]
+
+    planned, skipped = ghdwn.plan_downloads(index, 'largest-first')
+    assert [repo.name for repo in planned] == [
+        'huge', 'big', 'medium', 'small', 'unknown']
+    assert skipped == []
+
+    # Sizes are in KiB, but the limits are in bytes.
+    planned, skipped = ghdwn.plan_downloads(index, max_repo_size=50 * 1024,
+                                            max_total_size=55 * 1024)
+    assert [repo.name for repo in planned] == ['small', 'medium', 'unknown']
+    assert [repo.name for repo in skipped] == ['huge', 'big']
+
+    planned, _ = ghdwn.plan_downloads(index, 'bin-pack', workers=2)
+    assert [repo.name for repo in planned] == [
+        'huge', 'big', 'medium', 'small', 'unknown']
+
+
+def test_index_formats(tmpdir):
+    index = [ghdwn.RepositoryInfo('eddieantonio', 'dev', stars=28),
+             ghdwn.RepositoryInfo('django', 'reinhardt', 'stable')]
+
+    for format in ghdwn.INDEX_FORMATS:
+        path = str(tmpdir.join(ghdwn.INDEX_FORMATS[format]))
+        with ghdwn.IndexWriter(path, format) as writer:
+            for repo in index:
+                writer.write(repo)
+        assert ghdwn.load_index(path) == index
+        assert ghdwn.load_index(path)[0].stars == 28
+
+    # A JSON Lines index can be read while it's still being written.
+    path = tmpdir.join('index.jsonl')
+    path.write('{"owner": "eddieantonio", "name": "dev"}\n{"owner": "dja')
+    assert list(ghdwn.read_index(str(path))) == [('eddieantonio', 'dev')]
+
+    # Repositories can't name directories outside of the corpus.
+    for owner, name in [('..', 'victim'), ('eddieantonio', '../dev'),
+                        ('eddieantonio', 'a\\b'), ('.', 'dev')]:
+        path.write(json.dumps({'owner': owner, 'name': name}) + '\n')
+        with pytest.raises(ValueError):
+            ghdwn.load_index(str(path))
+
+
+def test_repositories_stay_in_the_corpus(tmpdir):
+    # However it got past the index, nothing outside the corpus is touched.
+    victim = tmpdir.join('victim')
+    victim.join('precious.txt').write('Keep me\n', ensure=True)
+    repos = [ghdwn.RepositoryInfo('..', 'victim')]
+    backend = LocalBackend({('..', 'victim'): make_zip(
+        {'victim-master/dev.py': 'print("Hello, World!")\n'})})
+    failed = ghdwn.download_index(repos, str(tmpdir.join('corpus')),
+                                  processes=1, workers={'fetch': 1},
+                                  backend=backend)
+    assert failed == repos
+    assert victim.listdir() == [victim.join('precious.txt')]
+
+
+def test_download_from_index(tmpdir):
+    index = tmpdir.join('index.jsonl')
+    index.write('{"owner": "eddieantonio", "name": "dev"}\n')
+
+    httpretty.enable()
+    httpretty.register_uri(httpretty.GET,
+                           ghdwn.create_archive_url('eddieantonio', 'dev'),
+                           body=mock_data.dev_zip,
+                           content_type='application/zip')
+    # Any search would blow up.
+    httpretty.register_uri(httpretty.GET, ghdwn.GITHUB_SEARCH_URL, status=500)
+
+    corpus_dir = tmpdir.join('corpus')
+    exit_status = ghdwn.main(['ghdwn', '--index', str(index), str(corpus_dir)])
+
+    assert len(httpretty.HTTPretty.latest_requests) == 1
+    httpretty.disable()
+    httpretty.reset()
+
+    assert exit_status == 0
+    assert corpus_dir.join('eddieantonio', 'dev', 'dev.py').check(file=True)
+    assert not corpus_dir.join('index.json').check()
+
+
+def test_partitioned_download(tmpdir):
+    repos = [ghdwn.RepositoryInfo('eddieantonio', 'dev'),
+             ghdwn.RepositoryInfo('eddieantonio',
+                                  'syntax-errors-up-the-ying-yang')]
+    assert set(ghdwn.partition_of(repo, 2) for repo in repos) == set([0, 1])
+
+    httpretty.enable()
+    httpretty.register_uri(httpretty.GET, repos[0].archive_url,
+                           body=mock_data.dev_zip,
+                           content_type='application/zip')
+    httpretty.register_uri(httpretty.GET, repos[1].archive_url,
+                           body=mock_data.broken_zip,
+                           content_type='application/zip')
+
+    # Each "node" only downloads its share.
+    corpus_dir = tmpdir.join('corpus')
+    for number in range(2):
+        ghdwn.download_index(repos, str(corpus_dir), processes=1,
+                             partition=(number, 2), file_stats=True)
+    assert len(httpretty.HTTPretty.latest_requests) == 2
+
+    httpretty.disable()
+    httpretty.reset()
+
+    assert ghdwn.merge_manifests(str(corpus_dir)) == 2
+    manifest = [json.loads(line) for line in
+                corpus_dir.join(ghdwn.MANIFEST_NAME).readlines()]
+    assert [sorted(record['files']) for record in manifest] == [
+        ['dev.py', 'setup.py'],
+        ['working/__init__.py'],
+    ]
+
+    # The file statistics are merged into one set of columns.
+    file_stats = json.loads(corpus_dir.join(ghdwn.FILE_STATS_NAME).read())
+    assert file_stats['path'] == [
+        'eddieantonio/dev/dev.py',
+        'eddieantonio/dev/setup.py',
+        'eddieantonio/syntax-errors-up-the-ying-yang/working/__init__.py',
+    ]
+    dev_py = corpus_dir.join('eddieantonio', 'dev', 'dev.py').read()
+    assert file_stats['bytes'][0] == len(dev_py)
+    assert file_stats['lines'][0] == dev_py.count('\n')
+    assert all(tokens > 0 for tokens in file_stats['tokens'])
+
+
+def test_coordinate_local_workers(tmpdir):
+    # Nothing to download, but the workers still have to do their part.
+    index = tmpdir.join('index.jsonl')
+    index.write('')
+    corpus_dir = tmpdir.join('corpus')
+
+    assert ghdwn.coordinate(str(index), str(corpus_dir), 3) == 0
+    for number in range(3):
+        part = ghdwn.MANIFEST_PART_NAME.format(number, 3)
+        assert corpus_dir.join(part).check(file=True)
+    assert corpus_dir.join(ghdwn.MANIFEST_NAME).read() == ''
+
+
+def test_coordinate_passes_options_on(tmpdir, monkeypatch):
+    commands = []
+
+    class Worker(object):
+        def __init__(self, argv, env=None):
+            commands.append(argv)
+
+        def wait(self):
+            return 0
+    monkeypatch.setattr(subprocess, 'Popen', Worker)
+
+    argv = ['index.json', str(tmpdir), '--coordinate', '2', '--backend',
+            'git', '--compress', 'gzip', '--sample-per-repo', '100',
+            '--time-limit', '1h', '--max-memory', '2G']
+    assert ghdwn.fetch_command(argv) == 0
+    assert len(commands) == 2
+    for command in commands:
+        options = ghdwn.pop_download_options(command)
+        assert options == {'backend': 'git', 'compression': 'gzip',
+                           'sample_per_repo': 100, 'time_limit': 3600.0,
+                           'max_memory': ghdwn.parse_size('1G')}
+
+    # Limits on the whole run can't be split up.
+    del commands[:]
+    for option, value in [('--sample', '100'), ('--target-files', '100'),
+                          ('--target-size', '10G')]:
+        with pytest.raises(ValueError):
+            ghdwn.fetch_command(['index.json', str(tmpdir),
+                                 '--coordinate', '2', option, value])
+        with pytest.raises(ValueError):
+            ghdwn.fetch_command(['index.json', str(tmpdir),
+                                 '--partition', '0/2', option, value])
+    assert commands == []
+
+    with pytest.raises(ValueError):
+        ghdwn.download_index([], str(tmpdir), backend='gti')
+
+
+def test_git_backend(tmpdir, monkeypatch):
+    def git(*args):
+        subprocess.check_call(('git', '-c', 'user.name=Eddie',
+                               '-c', 'user.email=eddie@example.com') + args,
+                              cwd=str(work_dir))
+
+    # Make a repository to fetch from.
+    work_dir = tmpdir.join('work')
+    work_dir.ensure(dir=True)
+    git('init', '--quiet')
+    git('checkout', '--quiet', '-b', 'master')
+    work_dir.join('dev.py').write('print("Hello, World!")\n')
+    work_dir.join('README.rst').write('Hello, World!\n')
+    git('add', '.')
+    git('commit', '--quiet', '-m', 'Initial commit')
+    remote = tmpdir.join('remote')
+    git('clone', '--quiet', '--bare', str(work_dir),
+        str(remote.join('eddieantonio', 'dev.git')))
+
+    repo = ghdwn.RepositoryInfo('eddieantonio', 'dev')
+    corpus_dir = tmpdir.join('corpus')
+    backend = ghdwn.GitBackend(base_url=str(remote))
+    builder = ghdwn.CorpusBuilder(str(corpus_dir), backend=backend)
+
+    assert builder.run([repo]) == []
+    repo_dir = corpus_dir.join('eddieantonio', 'dev')
+    assert repo_dir.join('dev.py').check(file=True)
+    assert not repo_dir.join('README.rst').check()
+
+    # Fetching again picks up the changes.
+    work_dir.join('setup.py').write('from setuptools import setup\n')
+    git('add', '.')
+    git('commit', '--quiet', '-m', 'Add setup.py')
+    git('push', '--quiet', str(remote.join('eddieantonio', 'dev.git')),
+        'master')
+
+    assert builder.run([repo]) == []
+    assert repo_dir.join('setup.py').check(file=True)
+
+    # Branch names from an index are never taken for options.
+    monkeypatch.chdir(str(tmpdir))
+    sleeps = []
+    backend = ghdwn.GitBackend(base_url=str(remote),
+                               retry=ghdwn.RetryPolicy(sleep=sleeps.append))
+    evil = ghdwn.RepositoryInfo(
+        'eddieantonio', 'dev',
+        default_branch='--upload-pack=touch PWNED;git-upload-pack')
+    assert backend.fetch(evil, str(tmpdir.join('staging'))) is None
+    assert not tmpdir.join('PWNED').check()
+
+    # Failed fetches are retried, without waiting on a prompt.
+    missing = ghdwn.RepositoryInfo('eddieantonio', 'gone')
+    assert backend.fetch(missing, str(tmpdir.join('staging'))) is None
+    assert len(sleeps) == 3
+
+    # And git is killed if it takes too long.
+    with pytest.raises(ghdwn.GitFailed):
+        ghdwn.run_git(['sleep', '10'], timeout=0.1)
+
+
+class LocalBackend(object):
+    """
+    Fetches repositories from zip archives that are already in memory.
+    """
+
+    def __init__(self, archives):
+        self.archives = archives
+
+    def fetch(self, repo, staging_dir):
+        path = '{0}/{1}-{2}.zip'.format(staging_dir, repo.owner, repo.name)
+        with open(path, 'wb') as f:
+            f.write(self.archives[repo.key])
+        return ghdwn.ZipSnapshot(path)
+
+
+def make_zip(files):
+    import io
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_DEFLATED) as archive:
+        for name, content in sorted(files.items()):
+            archive.writestr(name, content)
+    return buffer.getvalue()
+
+
+def test_near_duplicates(tmpdir):
+    original = ''.join('def f{0:d}(x):\n    return x + {0:d}\n'.format(n)
+                       for n in range(50))
+    edited = original.replace('return x + 25', 'return x - 25')
+
+    backend = LocalBackend({
+        ('alice', 'utils'): make_zip({'utils-master/utils.py': original}),
+        ('bob', 'vendored'): make_zip({
+            'vendored-master/alices_utils.py': edited,
+            'vendored-master/other.py': 'print("Something else")\n',
+        }),
+    })
+    repos = [ghdwn.RepositoryInfo('alice', 'utils'),
+             ghdwn.RepositoryInfo('bob', 'vendored')]
+
+    corpus_dir = tmpdir.join('corpus')
+    ghdwn.download_index(repos, str(corpus_dir), processes=1,
+                         workers={'fetch': 1}, backend=backend,
+                         near_dedup='drop')
+
+    assert corpus_dir.join('alice', 'utils', 'utils.py').check(file=True)
+    assert not corpus_dir.join('bob', 'vendored', 'alices_utils.py').check()
+    assert corpus_dir.join('bob', 'vendored', 'other.py').check(file=True)
+
+    # Or, keep them, but say where they came from.
+    corpus_dir = tmpdir.join('tagged')
+    ghdwn.download_index(repos, str(corpus_dir), processes=1,
+                         workers={'fetch': 1}, backend=backend,
+                         near_dedup='tag')
+    manifest = ghdwn.load_manifest(str(corpus_dir.join(ghdwn.MANIFEST_NAME)))
+    files = manifest[('bob', 'vendored')]['files']
+    assert files['alices_utils.py']['near_duplicate_of'] == \
+        'alice/utils/utils.py'
+    assert 'near_duplicate_of' not in files['other.py']
+
+    # Anything else is a mistake, not a synonym for 'tag'.
+    with pytest.raises(ValueError):
+        ghdwn.download_index(repos, str(tmpdir.join('typo')), processes=1,
+                             backend=backend, near_dedup='dorp')
+
+
+def test_near_duplicates_of_failed_repositories(tmpdir, monkeypatch):
+    files = dict(('lib-master/mod{0:d}.py'.format(n),
+                  ''.join('v{0:d}_{1:d} = {1:d}\n'.format(n, i)
+                          for i in range(20)))
+                 for n in range(70))
+    backend = LocalBackend({('someone', 'lib'): make_zip(files)})
+    repos = [ghdwn.RepositoryInfo('someone', 'lib')]
+
+    # The disk hiccups once, partway through the repository.
+    write_file = ghdwn.write_file
+    hiccups = []
+
+    def flaky_write_file(directory, path, content):
+        if path.endswith('mod35.py') and not hiccups:
+            hiccups.append(path)
+            raise IOError('Resource temporarily unavailable')
+        return write_file(directory, path, content)
+    monkeypatch.setattr(ghdwn, 'write_file', flaky_write_file)
+
+    # Retrying it doesn't find its files to duplicate themselves.
+    corpus_dir = tmpdir.join('corpus')
+    failed = ghdwn.download_index(repos, str(corpus_dir), processes=1,
+                                  workers={'fetch': 1}, backend=backend,
+                                  near_dedup='drop')
+    assert hiccups and not failed
+    assert len(corpus_dir.join('someone', 'lib').listdir()) == 70
+
+
+def test_near_duplicates_of_evicted_files(tmpdir):
+    original = ''.join('def f{0:d}(x):\n    return x + {0:d}\n'.format(n)
+                       for n in range(50))
+    edited = original.replace('return x + 25', 'return x - 25')
+    backend = LocalBackend({
+        ('alice', 'utils'): make_zip({'utils-master/utils.py': original}),
+        ('bob', 'vendored'): make_zip({
+            'vendored-master/alices_utils.py': edited}),
+    })
+    repos = [ghdwn.RepositoryInfo('alice', 'utils'),
+             ghdwn.RepositoryInfo('bob', 'vendored')]
+
+    # Bob's copy pushes Alice's original out of the sample, so it's no
+    # longer a near duplicate of anything in the corpus.
+    corpus_dir = tmpdir.join('corpus')
+    ghdwn.download_index(repos, str(corpus_dir), processes=1,
+                         workers={'fetch': 1}, backend=backend,
+                         near_dedup='tag', sample=1, seed=0)
+    manifest = ghdwn.load_manifest(str(corpus_dir.join(ghdwn.MANIFEST_NAME)))
+    assert manifest[('alice', 'utils')]['files'] == {}
+    assert manifest[('bob', 'vendored')]['files']['alices_utils.py'].get(
+        'near_duplicate_of') is None
+    assert not corpus_dir.join('alice', 'utils', 'utils.py').check()
+
+
+def test_forks_and_mirrors(tmpdir):
+    files = {'setup.py': 'from setuptools import setup\n',
+             'dev.py': 'print("Hello, World!")\n'}
+
+    def archive(name):
+        return make_zip(dict((name + '-master/' + path, content)
+                             for path, content in files.items()))
+
+    backend = LocalBackend({
+        ('eddieantonio', 'dev'): archive('dev'),
+        ('someone', 'dev-mirror'): archive('dev-mirror'),
+        ('someone', 'dev'): archive('dev'),
+    })
+    repos = [
+        ghdwn.RepositoryInfo('eddieantonio', 'dev', fork=False),
+        ghdwn.RepositoryInfo('someone', 'dev-mirror', fork=False),
+        ghdwn.RepositoryInfo('someone', 'dev', fork=True,
+                             parent='eddieantonio/dev'),
+    ]
+
+    corpus_dir = tmpdir.join('corpus')
+    ghdwn.download_index(repos, str(corpus_dir), processes=1,
+                         workers={'fetch': 1}, backend=backend,
+                         skip_forks=True)
+
+    assert corpus_dir.join('eddieantonio', 'dev', 'dev.py').check(file=True)
+    assert not corpus_dir.join('someone', 'dev-mirror', 'dev.py').check()
+    assert not corpus_dir.join('someone', 'dev').check()
+
+    manifest = ghdwn.load_manifest(str(corpus_dir.join(ghdwn.MANIFEST_NAME)))
+    assert manifest[('someone', 'dev-mirror')]['mirror_of'] == \
+        'eddieantonio/dev'
+    assert ('someone', 'dev') not in manifest
+
+
+def test_refresh_skips_unchanged_files(tmpdir, monkeypatch):
+    files = {
+        'dev-master/dev.py': 'print("Hello, World!")\n',
+        'dev-master/setup.py': 'from setuptools import setup\n',
+        'dev-master/old.py': 'print("Going away")\n',
+        'dev-master/broken.py': 'print(\n',
+    }
+    backend = LocalBackend({('eddieantonio', 'dev'): make_zip(files)})
+    repos = [ghdwn.RepositoryInfo('eddieantonio', 'dev')]
+    corpus_dir = tmpdir.join('corpus')
+    ghdwn.download_index(repos, str(corpus_dir), processes=1,
+                         workers={'fetch': 1}, backend=backend)
+
+    manifest = ghdwn.load_manifest(str(corpus_dir.join(ghdwn.MANIFEST_NAME)))
+    record = manifest[('eddieantonio', 'dev')]
+    assert record['files']['dev.py']['size'] == len(files['dev-master/dev.py'])
+    assert 'crc' in record['files']['dev.py']
+    assert set(record['rejected']) == set(['broken.py'])
+
+    # Change one file, delete another, and watch which ones are read.
+    files['dev-master/dev.py'] = 'print("Hello, again!")\n'
+    del files['dev-master/old.py']
+    backend.archives[('eddieantonio', 'dev')] = make_zip(files)
+    validated = []
+    validate_batch = ghdwn.validate_batch
+
+    def spy(job):
+        validated.extend(job[1])
+        return validate_batch(job)
+    monkeypatch.setattr(ghdwn, 'validate_batch', spy)
+
+    ghdwn.download_index(repos, str(corpus_dir), processes=1,
+                         workers={'fetch': 1}, backend=backend)
+
+    assert validated == ['dev-master/dev.py']
+    repo_dir = corpus_dir.join('eddieantonio', 'dev')
+    assert repo_dir.join('dev.py').read() == 'print("Hello, again!")\n'
+    assert repo_dir.join('setup.py').check(file=True)
+    assert not repo_dir.join('old.py').check()
+
+    manifest = ghdwn.load_manifest(str(corpus_dir.join(ghdwn.MANIFEST_NAME)))
+    record = manifest[('eddieantonio', 'dev')]
+    assert sorted(record['files']) == ['dev.py', 'setup.py']
+    assert set(record['rejected']) == set(['broken.py'])
+
+
+def test_compressed_corpus(tmpdir):
+    files = {'dev-master/dev.py': 'print("Hello, World!")\n',
+             'dev-master/pkg/__init__.py': 'from os import path\n'}
+    backend = LocalBackend({('eddieantonio', 'dev'): make_zip(files)})
+    repos = [ghdwn.RepositoryInfo('eddieantonio', 'dev')]
+    corpus_dir = tmpdir.join('corpus')
+    ghdwn.download_index(repos, str(corpus_dir), processes=1,
+                         workers={'fetch': 1}, backend=backend,
+                         compression='gzip')
+
+    repo_dir = corpus_dir.join('eddieantonio', 'dev')
+    assert repo_dir.join('dev.py.gz').check(file=True)
+    assert not repo_dir.join('dev.py').check()
+
+    corpus = list(ghdwn.CorpusReader(str(corpus_dir)))
+    assert [(str(repo), path, content) for repo, path, content in corpus] == [
+        ('eddieantonio/dev', 'dev.py', b'print("Hello, World!")\n'),
+        ('eddieantonio/dev', 'pkg/__init__.py', b'from os import path\n'),
+    ]
+
+
+def test_zstd_compressed_corpus(tmpdir, monkeypatch):
+    pytest.importorskip('zstandard')
+    monkeypatch.setattr(ghdwn, 'DICTIONARY_SAMPLES', 2)
+    files = dict(('lib-master/mod{0:d}.py'.format(n),
+                  'def f(x):\n    return x + {0:d}\n'.format(n))
+                 for n in range(4))
+    backend = LocalBackend({('someone', 'lib'): make_zip(files)})
+    corpus_dir = tmpdir.join('corpus')
+    ghdwn.download_index([ghdwn.RepositoryInfo('someone', 'lib')],
+                         str(corpus_dir), processes=1, workers={'fetch': 1},
+                         backend=backend, compression='zstd')
+
+    corpus = ghdwn.CorpusReader(str(corpus_dir))
+    assert sorted((path, content.decode('utf-8'))
+                  for _, path, content in corpus) == \
+        sorted((name.split('/', 1)[1], content)
+               for name, content in files.items())
+
+
+def test_repositories_are_committed_whole(tmpdir, monkeypatch):
+    files = {'dev-master/dev.py': 'print("Hello, World!")\n',
+             'dev-master/setup.py': 'from setuptools import setup\n'}
+    backend = LocalBackend({('eddieantonio', 'dev'): make_zip(files)})
+    repos = [ghdwn.RepositoryInfo('eddieantonio', 'dev')]
+    corpus_dir = tmpdir.join('corpus')
+    repo_dir = corpus_dir.join('eddieantonio', 'dev')
+    failed = ghdwn.download_index(repos, str(corpus_dir), processes=1,
+                                  workers={'fetch': 1}, backend=backend,
+                                  fsync='repo')
+    assert not failed
+    assert sorted(path.basename for path in repo_dir.listdir()) == \
+        ['dev.py', 'setup.py']
+
+    # The disk fills up halfway through refreshing the repository.
+    files['dev-master/dev.py'] = 'print("Hello, again!")\n'
+    files['dev-master/new.py'] = 'print("New!")\n'
+    backend.archives[('eddieantonio', 'dev')] = make_zip(files)
+    write_file = ghdwn.write_file
+
+    def flaky_write_file(directory, path, content):
+        if path.endswith('new.py'):
+            raise IOError('No space left on device')
+        return write_file(directory, path, content)
+    monkeypatch.setattr(ghdwn, 'write_file', flaky_write_file)
+
+    failed = ghdwn.download_index(repos, str(corpus_dir), processes=1,
+                                  workers={'fetch': 1}, backend=backend,
+                                  fsync='end')
+    assert failed == repos
+
+    # The last complete copy is still there, and nothing half-written.
+    assert sorted(path.basename for path in repo_dir.listdir()) == \
+        ['dev.py', 'setup.py']
+    assert repo_dir.join('dev.py').read() == 'print("Hello, World!")\n'
+    assert not corpus_dir.join(ghdwn.STAGING_DIR).listdir('*-dev-*')
+
+    # Or the power goes out just before the new copy takes over: the files
+    # carried over are still in the old copy too.
+    monkeypatch.setattr(ghdwn, 'write_file', write_file)
+    rename = ghdwn.os.rename
+
+    def crashing_rename(source, destination):
+        if destination.endswith('.old'):
+            raise OSError('Power failure')
+        return rename(source, destination)
+    monkeypatch.setattr(ghdwn.os, 'rename', crashing_rename)
+
+    failed = ghdwn.download_index(repos, str(corpus_dir), processes=1,
+                                  workers={'fetch': 1}, backend=backend)
+    assert failed == repos
+    assert sorted(path.basename for path in repo_dir.listdir()) == \
+        ['dev.py', 'setup.py']
+    monkeypatch.undo()
+
+    with pytest.raises(ValueError):
+        ghdwn.download_index(repos, str(corpus_dir), processes=1,
+                             backend=backend, fsync='always')
+
+
+def test_memory_budget(tmpdir):
+    big = ''.join('x{0:d} = {0:d}\n'.format(n) for n in range(2000))
+    files = {'dev-master/big.py': big,
+             'dev-master/dev.py': 'print("Hello, World!")\n',
+             'dev-master/setup.py': 'from setuptools import setup\n'}
+    backend = LocalBackend({('eddieantonio', 'dev'): make_zip(files)})
+    repos = [ghdwn.RepositoryInfo('eddieantonio', 'dev')]
+    corpus_dir = tmpdir.join('corpus')
+    failed = ghdwn.download_index(repos, str(corpus_dir), processes=1,
+                                  workers={'fetch': 1}, backend=backend,
+                                  max_memory=ghdwn.parse_size('16K'))
+    assert not failed
+
+    # The big file went by way of the disk, and everything was released.
+    repo_dir = corpus_dir.join('eddieantonio', 'dev')
+    assert repo_dir.join('big.py').read() == big
+    assert repo_dir.join('dev.py').check(file=True)
+    assert not corpus_dir.join(ghdwn.STAGING_DIR).listdir('*.spill')
+
+
+def test_sampling(tmpdir, monkeypatch):
+    def archive(name, files):
+        return make_zip(dict(
+            ('{0}-master/mod{1:d}.py'.format(name, n),
+             'x = {0:d}\n'.format(n)) for n in range(files)))
+    backend = LocalBackend({
+        ('alice', 'big'): archive('big', 40),
+        ('bob', 'small'): archive('small', 3),
+    })
+    repos = [ghdwn.RepositoryInfo('alice', 'big'),
+             ghdwn.RepositoryInfo('bob', 'small')]
+
+    validated = []
+    validate_batch = ghdwn.validate_batch
+
+    def spy(job):
+        validated.extend(job[1])
+        return validate_batch(job)
+    monkeypatch.setattr(ghdwn, 'validate_batch', spy)
+
+    def sample(directory, **options):
+        corpus_dir = tmpdir.join(directory)
+        ghdwn.download_index(repos, str(corpus_dir), processes=1,
+                             workers={'fetch': 1}, backend=backend,
+                             **options)
+        manifest = ghdwn.load_manifest(
+            str(corpus_dir.join(ghdwn.MANIFEST_NAME)))
+        on_disk = set(
+            path.relto(corpus_dir).replace('\\', '/')
+            for path in corpus_dir.visit('*.py'))
+        listed = set('/'.join(key) + '/' + path
+                     for key, record in manifest.items()
+                     for path in record['files'])
+        assert on_disk == listed
+        return on_disk
+
+    kept = sample('capped', sample_per_repo=5, seed=42)
+    assert len([path for path in kept if path.startswith('alice/')]) == 5
+    assert len([path for path in kept if path.startswith('bob/')]) == 3
+    # Most of the big repository was never even inflated.
+    assert len(validated) == 5 + 3
+
+    kept = sample('total', sample=10, seed=42)
+    assert len(kept) == 10
+    assert sample('again', sample=10, seed=42) == kept
+    assert sample('reseeded', sample=10, seed=7) != kept
+
+
+def test_sampling_failed_repositories(tmpdir, monkeypatch):
+    files = dict(('lib-master/mod{0:d}.py'.format(n), 'x = {0:d}\n'.format(n))
+                 for n in range(30))
+    backend = LocalBackend({('someone', 'lib'): make_zip(files)})
+    repos = [ghdwn.RepositoryInfo('someone', 'lib')]
+
+    write_file = ghdwn.write_file
+    hiccups = []
+
+    def flaky_write_file(directory, path, content):
+        if len(hiccups) < 5:
+            hiccups.append(path)
+            if len(hiccups) == 5:
+                raise IOError('Resource temporarily unavailable')
+        return write_file(directory, path, content)
+    monkeypatch.setattr(ghdwn, 'write_file', flaky_write_file)
+
+    # What the broken attempt added doesn't count against the retry.
+    corpus_dir = tmpdir.join('corpus')
+    failed = ghdwn.download_index(repos, str(corpus_dir), processes=1,
+                                  workers={'fetch': 1}, backend=backend,
+                                  sample_per_repo=10, seed=42)
+    assert not failed
+    assert len(corpus_dir.join('someone', 'lib').listdir()) == 10
+
+
+def test_sampling_reserves_what_it_validates(tmpdir, monkeypatch):
+    budgets = []
+
+    class Budget(ghdwn.MemoryBudget):
+        peak = 0
+
+        def reserve(self, amount):
+            super(Budget, self).reserve(amount)
+            self.peak = max(self.peak, self.reserved)
+            budgets.append(self)
+    monkeypatch.setattr(ghdwn, 'MemoryBudget', Budget)
+
+    body = ''.join('x{0:d} = {0:d}\n'.format(n) for n in range(200))
+    backend = LocalBackend({('alice', 'big'): make_zip(dict(
+        ('big-master/mod{0:d}.py'.format(n), '# {0:d}\n{1}'.format(n, body))
+        for n in range(200)))})
+    corpus_dir = tmpdir.join('corpus')
+    failed = ghdwn.download_index([ghdwn.RepositoryInfo('alice', 'big')],
+                                  str(corpus_dir), processes=1,
+                                  workers={'fetch': 1}, backend=backend,
+                                  max_memory=ghdwn.parse_size('64K'),
+                                  sample_per_repo=5, seed=42)
+    assert not failed
+    assert len(corpus_dir.join('alice', 'big').listdir()) == 5
+    # Only the files that were validated were ever reserved.
+    budget = budgets[0]
+    assert 0 < budget.peak <= ghdwn.parse_size('64K')
+    assert budget.reserved == 0
+
+
+def test_members_are_streamed(tmpdir):
+    import io
+
+    class Member(io.BytesIO):
+        def __init__(self, content):
+            super(Member, self).__init__(content)
+            self.bytes_read = 0
+
+        def read(self, size=-1):
+            data = super(Member, self).read(size)
+            self.bytes_read += len(data)
+            return data
+
+    # Binary files are turned away having only been sniffed.
+    image = Member(b'\x89PNG\r\n\x1a\n' + b'\x00' * (1024 * 1024))
+    assert ghdwn.read_member(image, {}) == ('magic:png', None)
+    assert image.bytes_read == ghdwn.SNIFF_SIZE
+
+    # Big files go to disk as they're read.
+    source = b''.join(b'x' + str(n).encode('ascii') + b' = 1\n'
+                      for n in range(20000))
+    reason, content = ghdwn.read_member(Member(source), {
+        'spill_size': 4096, 'spill_dir': str(tmpdir)})
+    assert reason is None
+    assert isinstance(content, ghdwn.SpilledFile)
+    assert content.read() == source
+    assert ghdwn.syntax_ok(content)
+    content.remove()
+
+    # Unless they're not text after all.
+    reason, content = ghdwn.read_member(Member(source + b'\xff\xfe'), {
+        'spill_size': 4096, 'spill_dir': str(tmpdir)})
+    assert reason == 'encoding'
+    assert not tmpdir.listdir('*.spill')
+
+
+def test_status_and_stats(tmpdir, capsys):
+    files = {'dev-master/dev.py': 'print("Hello, World!")\n',
+             'dev-master/setup.py': 'from setuptools import setup\n'}
+    backend = LocalBackend({('eddieantonio', 'dev'): make_zip(files)})
+    repos = [ghdwn.RepositoryInfo('eddieantonio', 'dev'),
+             ghdwn.RepositoryInfo('eddieantonio', 'ghdwn')]
+    corpus_dir = tmpdir.join('corpus')
+    corpus_dir.mkdir()
+    with ghdwn.IndexWriter(str(corpus_dir.join('index.json')), 'json') as f:
+        for repo in repos:
+            f.write(repo)
+    ghdwn.download_index(repos[:1], str(corpus_dir), processes=1,
+                         workers={'fetch': 1}, backend=backend)
+
+    assert ghdwn.main(['ghdwn', 'status', str(corpus_dir)]) == 0
+    assert ghdwn.main(['ghdwn', 'stats', str(corpus_dir)]) == 0
+    out, _ = capsys.readouterr()
+    assert out.splitlines() == [
+        'indexed: 2', 'downloaded: 1', 'mirrors: 0', 'remaining: 1',
+        'files: 2',
+        'files: 2', 'bytes: {0:d}'.format(sum(map(len, files.values()))),
+    ]
+
+    # Before the first run has even made the directory, there's nothing.
+    missing = str(tmpdir.join('not-yet'))
+    assert ghdwn.main(['ghdwn', 'status', missing]) == 0
+    assert ghdwn.main(['ghdwn', 'stats', missing]) == 0
+    out, _ = capsys.readouterr()
+    assert out.splitlines() == [
+        'indexed: 0', 'downloaded: 0', 'mirrors: 0', 'remaining: 0',
+        'files: 0',
+        'files: 0', 'bytes: 0',
+    ]
+
+
+def test_quick_commands_skip_heavy_imports(tmpdir):
+    import sys
+    script = (
+        'import sys, ghdwn\n'
+        'ghdwn.main(["ghdwn", "status", sys.argv[1]])\n'
+        'heavy = ["multiprocessing", "zipfile", "subprocess", "urllib2",\n'
+        '         "urllib.request", "zstandard"]\n'
+        'sys.stdout.write(repr([name for name in heavy\n'
+        '                       if name in sys.modules]))\n'
+    )
+    output = subprocess.check_output(
+        [sys.executable, '-c', script, str(tmpdir)],
+        cwd=str(tmpdir), env={'PYTHONPATH': str(py.path.local(ghdwn.__file__)
+                                                .dirpath())})
+    assert output.decode('utf-8').splitlines()[-1] == '[]'
+
+
+def test_decode_search_page():
+    for text in mock_data.search_bodies:
+        body = text if isinstance(text, bytes) else text.encode('utf-8')
+        items = json.loads(body.decode('utf-8'))['items']
+        expected = [ghdwn.RepositoryInfo.from_json(item) for item in items]
+
+        repos = ghdwn.decode_search_page(body)
+        assert repos == expected
+        assert [repo.stars for repo in repos] == [
+            repo.stars for repo in expected]
+
+        fields = ('owner.login', 'name', 'stargazers_count', 'fork')
+        assert ghdwn.decode_search_page(body, fields) == [
+            (repo.owner, repo.name, repo.stars, repo.fork)
+            for repo in expected]
+
+
+def test_record_and_replay(tmpdir, monkeypatch):
+    monkeypatch.chdir(tmpdir)
+    traffic = str(tmpdir.join('traffic'))
+
+    httpretty.enable()
+    body = iter(mock_data.abbrev_search_bodies)
+
+    def request_callback(request, uri, headers):
+        headers['Content-Type'] = 'application/json; charset=utf-8'
+        headers['Link'] = (
+            '<https://api.github.com/search/repositories?'
+            'q=language%3Apython&sort=stars&page=1>; rel="last"')
+        return 200, headers, next(body)
+
+    httpretty.register_uri(httpretty.GET,
+                           "https://api.github.com/search/repositories",
+                           body=request_callback)
+    httpretty.register_uri(httpretty.GET,
+                           ghdwn.create_archive_url('eddieantonio', 'dev'),
+                           body=mock_data.dev_zip,
+                           content_type='application/zip')
+    httpretty.register_uri(httpretty.GET,
+                           ghdwn.create_archive_url(
+                               'eddieantonio',
+                               'syntax-errors-up-the-ying-yang'),
+                           body=mock_data.broken_zip,
+                           content_type='application/zip')
+    httpretty.register_uri(httpretty.GET,
+                           ghdwn.create_archive_url('django', 'reinhardt'),
+                           status=404)
+
+    try:
+        ghdwn.use_transport('record', traffic)
+        recorded = ghdwn.download_corpus('python', 'recorded')
+    finally:
+        ghdwn.use_transport(None)
+        httpretty.disable()
+        httpretty.reset()
+
+    # Every archive's body is stored once, under its SHA-1.
+    import hashlib
+    digest = hashlib.sha1(mock_data.dev_zip).hexdigest()
+    assert tmpdir.join('traffic', 'objects', digest[:2],
+                       digest[2:]).read_binary() == mock_data.dev_zip
+
+    # No network this time: anything not recorded is an error, and one
+    # that's not worth retrying.
+    sleeps = []
+    try:
+        ghdwn.use_transport('replay', traffic)
+        replayed = ghdwn.download_corpus('python', 'replayed')
+        with pytest.raises(ghdwn.NotRecorded):
+            ghdwn.web().urlopen(ghdwn.create_github_request(
+                ghdwn.create_archive_url('django', 'django')))
+        assert ghdwn.download_repo_zip(
+            ghdwn.RepositoryInfo('django', 'django'),
+            ghdwn.RetryPolicy(sleep=sleeps.append),
+            str(tmpdir)) is None
+    finally:
+        ghdwn.use_transport(None)
+    assert sleeps == []
+
+    # Replaying traffic that was never recorded is a mistake.
+    with pytest.raises(ValueError):
+        ghdwn.use_transport('replay', str(tmpdir.join('trafic')))
+    assert not tmpdir.join('trafic').check()
+
+    assert recorded == replayed == [('django', 'reinhardt')]
+    assert (tmpdir.join('recorded', 'index.json').read() ==
+            tmpdir.join('replayed', 'index.json').read())
+    # Repositories finish in whatever order they finish in.
+    manifests = [dict(ghdwn.load_manifest(str(tmpdir.join(
+        name, 'manifest.jsonl')))) for name in ('recorded', 'replayed')]
+    assert manifests[0] == manifests[1]
+    assert tmpdir.join('replayed', 'eddieantonio', 'dev',
+                       'dev.py').check(file=True)
+
+
+def test_stop_at_target(tmpdir):
+    def archive(name):
+        return make_zip(dict(
+            ('{0}-master/mod{1:d}.py'.format(name, n),
+             '{0} = {1:d}\n'.format(name, n)) for n in range(3)))
+    stars = {'meh': 10, 'best': 300, 'good': 200, 'okay': 100}
+    backend = LocalBackend(dict((('alice', name), archive(name))
+                                for name in stars))
+    repos = [ghdwn.RepositoryInfo('alice', name, stars=count)
+             for name, count in sorted(stars.items())]
+
+    def build(directory, **options):
+        corpus_dir = tmpdir.join(directory)
+        failed = ghdwn.download_index(repos, str(corpus_dir), processes=1,
+                                      workers={'fetch': 1}, backend=backend,
+                                      order='most-stars', **options)
+        assert failed == []
+        # Nothing cancelled is left lying around.
+        staging_dir = corpus_dir.join(ghdwn.STAGING_DIR)
+        assert not staging_dir.check() or staging_dir.listdir() == []
+        manifest = ghdwn.load_manifest(
+            str(corpus_dir.join(ghdwn.MANIFEST_NAME)))
+        alice = corpus_dir.join('alice')
+        on_disk = alice.listdir() if alice.check() else []
+        assert (set(name for _, name in manifest) ==
+                set(path.basename for path in on_disk))
+        return [name for _, name in manifest]
+
+    # Everything goes through in order of stars, one stage at a time, so
+    # the first repository to be committed is the only one.
+    assert build('files', target_files=2) == ['best']
+    assert build('plenty', target_files=100) == ['best', 'good', 'okay',
+                                                 'meh']
+    assert build('no-time', time_limit=0) == []
+
+
+def test_metrics_endpoint(tmpdir):
+    backend = LocalBackend({
+        ('alice', 'utils'): make_zip({'utils-master/utils.py': 'x = 1\n',
+                                      'utils-master/bad.py': 'x = (\n'}),
+    })
+    ghdwn.download_index([ghdwn.RepositoryInfo('alice', 'utils')],
+                         str(tmpdir), processes=1, backend=backend)
+
+    server = ghdwn.serve_metrics(('127.0.0.1', 0))
+    base = 'http://127.0.0.1:{0:d}'.format(server.server_address[1])
+    get = lambda path: ghdwn.web().urlopen(base + path).read().decode('utf-8')
+    try:
+        exposed = get('/metrics')
+        stacks = get('/debug/stacks')
+        profile = get('/debug/profile?seconds=0.1')
+        with pytest.raises(ghdwn.web().HTTPError):
+            get('/nope')
+    finally:
+        server.shutdown()
+        server.server_close()
+
+    assert '# TYPE ghdwn_files_total counter' in exposed
+    assert 'ghdwn_rejected_files_total{reason="syntax"}' in exposed
+    assert 'ghdwn_queue_length{stage="validate"} 0' in exposed
+    assert 'ghdwn_stage_in_progress{stage="fetch"} 0' in exposed
+    assert 'ghdwn_stage_seconds_bucket{stage="write",le="+Inf"}' in exposed
+    # The thread serving the request was busy dumping the stacks.
+    assert 'dump_stacks' in stacks
+    assert 'samples over 0.1 seconds' in profile
+
+
+def test_zstd_workers_keep_their_dictionaries(tmpdir, monkeypatch):
+    pytest.importorskip('zstandard')
+    monkeypatch.setattr(ghdwn, 'DICTIONARY_SAMPLES', 64)
+    monkeypatch.setattr(ghdwn, 'DICTIONARY_SIZE', 4096)
+    # Two partition workers start on the same directory at once.
+    compressors = [ghdwn.ZstdCompressor(str(tmpdir)) for _ in range(2)]
+    compressed = []
+    for worker, compressor in enumerate(compressors):
+        samples = [('def f{0:d}_{1:d}(x):\n    return x * {1:d} + {0:d}\n'
+                    .format(worker, n) * (n % 5 + 1)).encode('utf-8')
+                   for n in range(64)]
+        for content in samples:
+            compressor.compress(content)
+        assert compressor.dictionary is not None
+        compressed.extend((content, compressor.compress(content))
+                          for content in samples)
+    assert len(tmpdir.listdir()) == 2
+
+    dictionaries = ghdwn.CorpusReader(str(tmpdir)).dictionaries
+    for content, data in compressed:
+        assert ghdwn.decompress(data, '.zst', dictionaries) == content